@@ -1,91 +1,208 @@
 from typing import Union
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+import orjson
+from fastapi import FastAPI, Response
 from modules.llms import *
 from modules.utils import *
-
-_geographic_areas = read_jsonl_file("ITTER107/_geographic_areas.jsonl")
-_regions = read_jsonl_file("ITTER107/_regions.jsonl")
-_provinces = read_jsonl_file("ITTER107/_provinces.jsonl")
+from modules.locations import *
+from modules.response import *
+from modules.tools import *
+from modules.prompts import *
+from modules.batch import *
 
 llm_name = "gpt4"
 llm = initialize_AzureOpenAI_llm(llm_name)
-app = FastAPI()
+# "single": one tool-calling completion per prompt, locations resolved locally or chosen through the tool schema
+# "two_step": a completion for the location ids first, then the tool-calling completion
+LLM_CONVERSATION_MODE = config.get("LLM_CONVERSATION_MODE", "single")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    initialize_AzureOpenAI_clients([llm_name])
+    warm_catalog()
+    yield
+    await close_AzureOpenAI_clients()
+    await close_sdmx_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
-fastapi_response = {
-    "title": "Census Data",
-    "description": "A table from census data comparing geography with a population-based statistic.",
-    "type": "object",
-    "requestDuration": 0,
-    "requestTokens": 0,
-    "data": [],
-    "dataURL": "",
-    "dataSource": "Istat",
-    "analysis": ""
-}
+
+async def complete_tool_calls(prompt, messages):
+    """
+    Chooses the tool calls answering a prompt: from the completion cache, or with one (single) or two
+    (two_step) LLM completions. The messages of the conversation are appended to `messages`.
+
+    Returns:
+        tuple: (completion message with its tool_calls, location ids resolved locally, True if it came from the cache)
+    """
+    with timed_stage("location_resolve"):
+        location_ids, confidence = resolve_location_ids(prompt)
+    # A prompt answered before goes straight to the data fetch, without any LLM call
+    response = get_cached_completion(prompt, llm, signature=location_ids)
+    cached = response is not None
+    if cached:
+        print("\n\nFIRST response - tool calls from the completion cache")
+    else:
+        tool_definitions = get_tool_definitions()
+        if location_ids and confidence >= LOCATION_RESOLVER_MIN_CONFIDENCE:
+            # Resolved locally: skip the location LLM round trip and its long system prompt
+            messages.append({"role": "system", "content": "Return the id of the locations in the user's request, combined with '+' if multiple."})
+            messages.append({"role": "assistant", "content": location_ids})
+            print("\n\nFIRST response - location id (resolved locally): ", location_ids)
+        elif LLM_CONVERSATION_MODE == "two_step":
+            system_location_ids_prompt = f"""
+        "From the provided list of locations, select the one that best matches the user's needs. 
+        Locations (id name), by geographic area and region, with the provinces of each region:
+        {build_location_prompt(prompt)}
+
+        Instruction:
+        Review the user prompts and the locations list, then return the id of the most relevant location without any extra text — just the id, nothing else.
+        If they are mupliple locations, combine them with a plus '+' sign.
+
+        Examples:
+        - Query: "Tell me the population of Sicilia" -> Response: "ITD3".
+        - Query: "I want the unemployment rate in Sud Italia?" -> "ITF".
+        - Query: "What is the population of Bologna, Ravenna and Parma?" -> "ITD55+ITD57+ITD52".
+
+        Important: Only return the exact string (e.g., "ITC41") without any additional words or explanations.
+        """
+            messages.append({"role": "system", "content": system_location_ids_prompt})
+            with timed_stage("location_llm"):
+                response = await get_chat_completion_async(messages, llm)
+            messages.append({"role": "assistant", "content": response.content})
+            print("\n\nFIRST response - location id: ", response.content)
+        else:
+            # Single turn: the model picks the ids from the tool schema in the same completion that calls the tool
+            tool_definitions = get_tool_definitions(location_choices=build_location_prompt(prompt))
+            if location_ids:
+                messages.append({"role": "system", "content": f"Locations probably mentioned by the user: {location_ids}."})
+            print("\n\nFIRST response - location id: chosen with the tool call")
+        with timed_stage("tool_llm"):
+            response = await get_chat_completion_async(messages, llm, tools=tool_definitions, tool_choice="auto")
+    return response, location_ids, cached
+
+
+async def run_completion_tool_calls(prompt, response, location_ids, cached):
+    """
+    Runs the tool calls of a completion concurrently, merges their tables and caches the completion if it answered.
+
+    Returns:
+        tuple: (merged PopulationTable or None, (tool call, arguments, result) tuples)
+    """
+    # Every tool call of the completion runs concurrently; age ranges are summed per call before merging
+    results = await run_tool_calls(response.tool_calls)
+    final_data = merge_tool_results(results)
+    if not cached and final_data is not None and all(arguments is not None for _, arguments, _ in results):
+        set_cached_completion(prompt, llm, [(tool_call.function.name, arguments) for tool_call, arguments, _ in results],
+                              signature=location_ids)
+    return final_data, results
 
 
 @app.post("/")
 async def generate_response(prompt):
+    start_request_metrics()
     messages = []
     messages.append({"role": "user", "content": prompt})
-
-    system_location_ids_prompt = f"""
-    "From the provided list of locations, select the one that best matches the user's needs. 
-    Geographic areas:
-    {_geographic_areas}; 
-    Regions:
-    {_regions}; 
-    Provinces:
-    {_provinces}. 
-
-    Instruction:
-    Review the user prompts and the locations list, then return the id of the most relevant location without any extra text — just the id, nothing else.
-    If they are mupliple locations, combine them with a plus '+' sign.
-
-    Examples:
-    - Query: "Tell me the population of Sicilia" -> Response: "ITD3".
-    - Query: "I want the unemployment rate in Sud Italia?" -> "ITF".
-    - Query: "What is the population of Bologna, Ravenna and Parma?" -> "ITD55+ITD57+ITD52".
-
-    Important: Only return the exact string (e.g., "ITC41") without any additional words or explanations.
-    """
-
-    messages.append({"role": "system", "content": system_location_ids_prompt})
-    response = get_chat_completion(messages, llm)
-    messages.append({"role": "assistant", "content": response.content})
-    print("\n\nFIRST response - location id: ", response.content)
-    response = get_chat_completion(messages, llm, tools=tools, tool_choice="auto")
+    response, location_ids, cached = await complete_tool_calls(prompt, messages)
     messages.append({"role": "assistant", "content": response})
-    tool_call = response.tool_calls[0]
-    params = json.loads(tool_call.function.arguments)
-    chosen_function = eval(tool_call.function.name)
-    final_data = chosen_function(**params)
+    final_data, results = await run_completion_tool_calls(prompt, response, location_ids, cached)
     if final_data is None:
         info_msg = "OOOPS! Your query returned no results. Try rephrasing your request with more detail."
         messages.append({"role": "assistant", "content": info_msg})
+        finish_request_metrics()
         return info_msg
     else:
         messages.append({"role": "assistant", "content": final_data})
         print("\n\nTHIRD response - chosen function: ", response)
-        print("\n\nfn name", tool_call.function.name)
-        print("\n\nparams", params)
-    print("\n\nfinal data", final_data)
-    location_ids_list = params['location_ids'].split('+')
-    for index, elem in enumerate(final_data):
-        elem_dict = {
-            "name": elem['location'],
-            "geoID": location_ids_list[index],
-            "groupID": "CL_ETA1",
-            "groupLabel": "Age class",
-            "unit": "individuals",
-            "categories": [
-                {
-                    "variableID": "TOTAL",
-                    "variableLabel": "Total Population",
-                    "value": int(elem['population'])
-                }
-            ]
-        }
-        fastapi_response["data"].append(elem_dict)
-    return fastapi_response
+        for tool_call, arguments, _ in results:
+            print("\n\nfn name", tool_call.function.name)
+            print("\n\nparams", arguments)
+    print("\n\nfinal data", len(final_data), "rows")
+    with timed_stage("serialization"):
+        # Built per request from the immutable template: nothing is shared between requests
+        encoded_data = orjson.dumps(build_population_data(final_data))
+    request_metrics = finish_request_metrics()
+    content = encode_population_response(None, request_metrics["duration_ms"], request_metrics["tokens"]["total_tokens"],
+                                         encoded_data)
+    return Response(content=content, media_type="application/json")
+
+
+@app.post("/batch")
+async def generate_batch_response(batch: BatchRequest):
+    """
+    Answers many prompts or structured queries in one request. Identical items are answered once, prompts
+    go to the LLM a few at a time, and queries differing only by location share their SDMX calls.
+    Results are returned in the order of the items, each with its `data` rows or an `error`.
+    """
+    start_request_metrics()
+    items = {}
+    for item in batch.items:
+        items.setdefault(batch_item_key(item), item)
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENT_COMPLETIONS)
+
+    async def complete(prompt):
+        async with semaphore:
+            return await complete_tool_calls(prompt, [{"role": "user", "content": prompt}])
+
+    prompt_keys = [key for key in items if key[0] == "prompt"]
+    completions = dict(zip(prompt_keys, await asyncio.gather(*(complete(items[key].prompt) for key in prompt_keys),
+                                                            return_exceptions=True)))
+    arguments = {}
+    for key, item in items.items():
+        if key[0] == "query":
+            try:
+                arguments[key] = validate_tool_arguments(population_tool_name, item.query.model_dump())
+            except ToolArgumentError as e:
+                arguments[key] = e
+    argument_sets = [value for value in arguments.values() if isinstance(value, dict)]
+    for completion in completions.values():
+        if not isinstance(completion, Exception):
+            argument_sets.extend(value for tool_call, value in validate_tool_calls(completion[0].tool_calls)
+                                 if value is not None and tool_call.function.name == population_tool_name)
+    with timed_stage("sdmx_prefetch"):
+        await prefetch_population_queries(argument_sets)
+
+    async def answer(key):
+        if key[0] == "query":
+            if isinstance(arguments[key], Exception):
+                return arguments[key]
+            return await run_structured_query(arguments[key])
+        completion = completions[key]
+        if isinstance(completion, Exception):
+            return completion
+        response, location_ids, cached = completion
+        final_data, _ = await run_completion_tool_calls(items[key].prompt, response, location_ids, cached)
+        return final_data
+
+    answers = dict(zip(items, await asyncio.gather(*(answer(key) for key in items), return_exceptions=True)))
+    with timed_stage("serialization"):
+        results_by_key = {}
+        for key, answer in answers.items():
+            if isinstance(answer, Exception):
+                results_by_key[key] = {"error": str(answer)}
+            elif answer is None:
+                results_by_key[key] = {"error": "The query returned no results."}
+            else:
+                results_by_key[key] = {"data": build_population_data(answer)}
+        results = [results_by_key[batch_item_key(item)] for item in batch.items]
+    request_metrics = finish_request_metrics()
+    content = orjson.dumps({
+        "requestDuration": request_metrics["duration_ms"],
+        "requestTokens": request_metrics["tokens"]["total_tokens"],
+        "results": results,
+    })
+    return Response(content=content, media_type="application/json")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**get_sdmx_cache_stats(), "completions": get_completion_cache_stats(), "upstream": get_sdmx_client_stats()}
+
 
+@app.get("/metrics")
+async def metrics():
+    return {**get_metrics(), "single_flight": get_single_flight_stats()}
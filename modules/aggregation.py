@@ -0,0 +1,133 @@
+import re
+
+import numpy as np
+
+from modules.table import *
+
+# Number of encoded single-year ages: 0..99 plus 100 for "100 and over"
+AGE_SLOTS = AGE_100_PLUS + 1
+
+# Standard demographic bands: children, working age, elderly
+DEFAULT_AGE_BANDS = [(0, 14), (15, 64), (65, None)]
+
+
+def parse_age_band(band):
+    """
+    Normalizes an age band to an inclusive (lower, upper) pair of encoded ages.
+
+    Accepts tuples such as (0, 14) or (65, None), strings such as "0-14", "65+", "Y15-64",
+    "Y_GE65" or "Y_UN15", and single ages such as 42 or "Y42".
+
+    Example:
+        parse_age_band("65+") -> (65, 100), parse_age_band("Y_UN15") -> (0, 14)
+    """
+    if isinstance(band, tuple):
+        lower, upper = band
+        return int(lower), AGE_100_PLUS if upper is None else int(upper)
+    if isinstance(band, int):
+        return band, band
+    text = band.strip().upper()
+    if text.startswith("Y_GE"):
+        return int(text[4:]), AGE_100_PLUS
+    if text.startswith("Y_UN"):
+        return 0, int(text[4:]) - 1
+    text = text.lstrip("Y")
+    match = re.fullmatch(r"(\d+)\+", text)
+    if match:
+        return int(match.group(1)), AGE_100_PLUS
+    match = re.fullmatch(r"(\d+)-(\d+)", text)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    if text.isdigit():
+        return int(text), int(text)
+    raise ValueError(f"Invalid age band: {band}")
+
+
+def _age_histograms(table):
+    """
+    One pass over the table: returns (groups table, matrix of populations by group and single-year age).
+    Groups are (location, sex, year) in order of first appearance; TOTAL and unknown ages are ignored.
+    """
+    by_age = table.take(table.age >= 0)
+    group_index, first_rows = by_age.group_keys(("location", "sex", "year"))
+    histograms = np.bincount(group_index.astype(np.int64) * AGE_SLOTS + by_age.age,
+                             weights=by_age.population, minlength=len(first_rows) * AGE_SLOTS)
+    return by_age.take(first_rows), histograms.reshape(len(first_rows), AGE_SLOTS).astype(np.int64)
+
+
+def _band_matrix(bands):
+    """ Boolean (ages x bands) membership matrix, so that overlapping bands are summed in the same pass. """
+    matrix = np.zeros((AGE_SLOTS, len(bands)), dtype=np.int64)
+    for column, (lower, upper) in enumerate(bands):
+        matrix[lower:upper + 1, column] = 1
+    return matrix
+
+
+def aggregate_age_bands(table, bands=DEFAULT_AGE_BANDS):
+    """
+    Sums single-year ages into several age bands at once, for every (location, sex, year).
+
+    Args:
+        table (PopulationTable): Population by single-year age.
+        bands (list): Age bands in any form accepted by `parse_age_band`, e.g. ["0-14", "15-64", "65+"].
+                      Bands may overlap.
+
+    Returns:
+        dict:
+            - "table": PopulationTable with one row per group and band (age and age_upper hold the band bounds).
+            - "shares": share of the group population in each band, aligned with the table rows.
+            - "totals": population of the group over all ages, aligned with the table rows.
+    """
+    bands = [parse_age_band(band) for band in bands]
+    groups, histograms = _age_histograms(table)
+    band_sums = histograms @ _band_matrix(bands)
+    totals = histograms.sum(axis=1)
+    group_count, band_count = band_sums.shape
+    rows = np.repeat(np.arange(group_count), band_count)
+    banded = groups.take(rows)
+    banded.population = band_sums.ravel()
+    banded.age = np.tile(np.array([lower for lower, _ in bands], dtype=np.int16), group_count)
+    banded.age_upper = np.tile(np.array([upper for _, upper in bands], dtype=np.int16), group_count)
+    group_totals = totals[rows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.where(group_totals > 0, banded.population / group_totals, 0.0)
+    return {"table": banded, "shares": shares, "totals": group_totals}
+
+
+def age_structure_indicators(table, young=(0, 14), working=(15, 64), old=(65, None)):
+    """
+    Computes age shares, dependency ratios and the ageing index for every (location, sex, year), from the band
+    sums of a single `aggregate_age_bands` pass.
+
+    Args:
+        table (PopulationTable): Population by single-year age.
+        young, working, old: The age bands of the ratios (defaults follow the ISTAT/Eurostat definitions).
+
+    Returns:
+        dict: "table" (one row per group, population summed over all ages) and arrays aligned with it:
+              "young_share", "working_share", "old_share", "youth_dependency", "old_age_dependency",
+              "total_dependency" (ratios are per 100 people of working age) and "ageing_index"
+              (elderly per 100 young). Ratios with a zero denominator are NaN.
+    """
+    bands = aggregate_age_bands(table, [young, working, old])
+    young_sum, working_sum, old_sum = bands["table"].population.reshape(-1, 3).T.astype(np.float64)
+    totals = bands["totals"][::3].astype(np.float64)
+    groups = bands["table"].take(np.arange(0, len(bands["table"]), 3))
+    groups.population = bands["totals"][::3]
+    groups.age = np.zeros(len(groups), dtype=np.int16)
+    groups.age_upper = np.full(len(groups), AGE_100_PLUS, dtype=np.int16)
+
+    def ratio(numerator, denominator, scale=1.0):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator > 0, numerator * scale / denominator, np.nan)
+
+    return {
+        "table": groups,
+        "young_share": ratio(young_sum, totals),
+        "working_share": ratio(working_sum, totals),
+        "old_share": ratio(old_sum, totals),
+        "youth_dependency": ratio(young_sum, working_sum, 100),
+        "old_age_dependency": ratio(old_sum, working_sum, 100),
+        "total_dependency": ratio(young_sum + old_sum, working_sum, 100),
+        "ageing_index": ratio(old_sum, young_sum, 100),
+    }
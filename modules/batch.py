@@ -0,0 +1,89 @@
+import json
+import asyncio
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, model_validator
+
+from modules.tools import *
+
+# Largest batch accepted by POST /batch
+BATCH_MAX_ITEMS = int(config.get("BATCH_MAX_ITEMS", 500))
+# Prompts of a batch sent to the LLM at the same time
+BATCH_MAX_CONCURRENT_COMPLETIONS = int(config.get("BATCH_MAX_CONCURRENT_COMPLETIONS", 8))
+
+population_tool_name = "fetch_population_for_locations_years_sex_age_via_sdmx"
+
+
+class StructuredQuery(BaseModel):
+    """ The arguments of the population tool, for callers that already know what to fetch. """
+    location_ids: str
+    sex: str = "9"
+    age: str = "TOTAL"
+    start_period: str
+    end_period: str
+
+
+class BatchItem(BaseModel):
+    """ One question of a batch: either a natural language prompt or a structured query. """
+    prompt: Optional[str] = None
+    query: Optional[StructuredQuery] = None
+
+    @model_validator(mode="after")
+    def check_one_of(self):
+        if (self.prompt is None) == (self.query is None):
+            raise ValueError("Each item needs either a prompt or a query")
+        return self
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+def batch_item_key(item):
+    """ Identifies identical items, answered once per batch. """
+    if item.prompt is not None:
+        return ("prompt", item.prompt.strip())
+    return ("query", json.dumps(item.query.model_dump(), sort_keys=True))
+
+
+def group_compatible_queries(argument_sets):
+    """
+    Groups population queries that differ only by location, so that each group can be fetched with shared
+    SDMX calls.
+
+    Args:
+        argument_sets (list of dict): Validated arguments of the population tool.
+
+    Returns:
+        dict: {(sex, age, start_period, end_period): [location ids]}.
+    """
+    groups = {}
+    for arguments in argument_sets:
+        key = (arguments["sex"], arguments["age"], arguments["start_period"], arguments["end_period"])
+        location_ids = groups.setdefault(key, [])
+        for location_id in arguments["location_ids"].split("+"):
+            if location_id not in location_ids:
+                location_ids.append(location_id)
+    return groups
+
+
+async def prefetch_population_queries(argument_sets):
+    """
+    Fetches every group of compatible queries at once (see `group_compatible_queries`), so that the queries of the
+    batch are then answered from the cache. The planner still splits each group within the URL budgets.
+    """
+    groups = group_compatible_queries(argument_sets)
+    results = await asyncio.gather(
+        *(fetch_population_table_async("+".join(location_ids), sex, age, start_period, end_period)
+          for (sex, age, start_period, end_period), location_ids in groups.items()),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"An error occurred while prefetching a batch: {result}")
+
+
+async def run_structured_query(arguments):
+    """ Runs the population tool with validated arguments; the table is aggregated over its ages like a tool call. """
+    table = await tool_registry[population_tool_name]["function"](**arguments)
+    return merge_tool_results([(None, arguments, table)])
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from modules.shared import *
+
+SDMX_CACHE_PATH = DATA_ISTAT_API_PATH + "/cache/sdmx.sqlite"
+SDMX_CACHE_MAX_ENTRIES = int(config.get("SDMX_CACHE_MAX_ENTRIES", 500000))
+# Rows kept on disk (one per series, about 100 bytes each)
+SDMX_CACHE_MAX_DISK_ENTRIES = int(config.get("SDMX_CACHE_MAX_DISK_ENTRIES", 2000000))
+SDMX_CACHE_DEFAULT_TTL = int(config.get("SDMX_CACHE_DEFAULT_TTL", 24 * 3600))
+# Series requested but absent upstream (e.g. a year not yet published) are retried after this many seconds
+SDMX_NEGATIVE_CACHE_TTL = int(config.get("SDMX_NEGATIVE_CACHE_TTL", 6 * 3600))
+# Time to live in seconds per dataflow: published yearly population figures are effectively immutable
+SDMX_CACHE_TTLS = {
+    "22_289_DF_DCIS_POPRES1_1": 30 * 24 * 3600,
+}
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache evicting the least recently used entry beyond `max_entries`.
+    Each entry can carry its own time to live, after which it is treated as missing.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def items(self):
+        """ Returns (key, value, expires_at) for every entry not expired, from least to most recently used. """
+        now = time.time()
+        with self._lock:
+            return [(key, value, expires_at) for key, (value, expires_at) in self._entries.items()
+                    if expires_at is None or expires_at >= now]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    Disk tier of the cache: a single SQLite database holding each key as JSON with its value and expiry,
+    opened once per thread in WAL mode so that readers never wait for a writer.
+    Beyond `max_entries` rows the least recently written ones are deleted, through an index on the write time.
+    """
+
+    # Keys per SELECT of `get_entries`, below SQLite's limit on bound parameters
+    lookup_batch_size = 500
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._count = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        """ Returns this thread's connection, creating the schema on first use. """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or getattr(self._local, "path", None) != self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    written_at REAL NOT NULL
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS entries_written_at ON entries (written_at);
+            """)
+            self._local.connection, self._local.path = connection, self.path
+        return connection
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key, ensure_ascii=False)
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key, allow_stale=False):
+        """ Returns (value, expires_at) for a key that is present and not expired (unless allow_stale), otherwise None. """
+        return self.get_entries([key], allow_stale).get(key)
+
+    def get_entries(self, keys, allow_stale=False):
+        """ Returns {key: (value, expires_at)} for the keys present and not expired (unless allow_stale), in a few queries. """
+        encoded = {self._key(key): key for key in keys}
+        now = time.time()
+        entries = {}
+        try:
+            connection = self._connection()
+            encoded_keys = list(encoded)
+            for i in range(0, len(encoded_keys), self.lookup_batch_size):
+                batch = encoded_keys[i:i + self.lookup_batch_size]
+                rows = connection.execute(
+                    f"SELECT key, value, expires_at FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch)
+                for key, value, expires_at in rows:
+                    if allow_stale or expires_at is None or expires_at >= now:
+                        entries[encoded[key]] = (json.loads(value), expires_at)
+        except sqlite3.Error as e:
+            print(f"An error occurred while reading the cache database: {e}")
+        return entries
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items, ttl=None):
+        """ Stores (key, value) pairs with the same time to live in one transaction. """
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        rows = [(self._key(key), json.dumps(value, ensure_ascii=False), expires_at, now) for key, value in items]
+        if not rows:
+            return
+        try:
+            connection = self._connection()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO entries (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)", rows)
+            with self._lock:
+                # Replaced keys are counted again: the count is only an upper bound, checked before evicting
+                if self._count is None:
+                    self._count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                else:
+                    self._count += len(rows)
+                over_budget = self._count > self.max_entries
+            if over_budget:
+                self._evict(connection)
+        except sqlite3.Error as e:
+            print(f"An error occurred while writing the cache database: {e}")
+
+    def _evict(self, connection):
+        # Drop the oldest entries until the cache is back to 90% of its budget
+        with connection:
+            count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            excess = count - int(self.max_entries * 0.9)
+            if count > self.max_entries and excess > 0:
+                connection.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY written_at LIMIT ?)", (excess,))
+                count -= excess
+        with self._lock:
+            self._count = count
+
+    def clear(self):
+        try:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM entries")
+        except sqlite3.Error as e:
+            print(f"An error occurred while clearing the cache database: {e}")
+        with self._lock:
+            self._count = 0
+
+
+sdmx_memory_cache = LRUCache(SDMX_CACHE_MAX_ENTRIES)
+sdmx_disk_cache = SQLiteCache(SDMX_CACHE_PATH, SDMX_CACHE_MAX_DISK_ENTRIES)
+sdmx_cache_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+sdmx_stale_hits = 0
+
+
+def get_cached_sdmx(key):
+    """
+    Looks up a parsed SDMX result, first in memory and then on disk (promoting disk hits to memory).
+
+    Args:
+        key (tuple): Normalized cache key whose first element is the dataflow id.
+
+    Returns:
+        The cached value, or None on a miss.
+    """
+    return get_cached_sdmx_many([key]).get(key)
+
+
+def get_cached_sdmx_many(keys):
+    """ Batched `get_cached_sdmx`: the keys missing from memory are read from disk together. Returns {key: value} for the hits. """
+    values = {}
+    disk_keys = []
+    for key in keys:
+        value = sdmx_memory_cache.get(key)
+        if value is None:
+            disk_keys.append(key)
+        else:
+            values[key] = value
+    sdmx_cache_stats["memory_hits"] += len(values)
+    if disk_keys:
+        now = time.time()
+        disk_entries = sdmx_disk_cache.get_entries(disk_keys)
+        for key, (value, expires_at) in disk_entries.items():
+            sdmx_memory_cache.set(key, value, expires_at - now if expires_at is not None else None)
+            values[key] = value
+        sdmx_cache_stats["disk_hits"] += len(disk_entries)
+    sdmx_cache_stats["misses"] += len(keys) - len(values)
+    return values
+
+
+def set_cached_sdmx(key, value, ttl=None):
+    """ Stores a parsed SDMX result in both tiers, by default with the time to live of its dataflow (`key[0]`). """
+    set_cached_sdmx_many([(key, value)], ttl)
+
+
+def set_cached_sdmx_many(items, ttl=None):
+    """
+    Stores (key, value) pairs in both tiers, writing the disk tier in one transaction per time to live.
+    By default each key gets the time to live of its dataflow (`key[0]`).
+    """
+    by_ttl = {}
+    for key, value in items:
+        key_ttl = ttl if ttl is not None else SDMX_CACHE_TTLS.get(key[0], SDMX_CACHE_DEFAULT_TTL)
+        by_ttl.setdefault(key_ttl, []).append((key, value))
+    for key_ttl, ttl_items in by_ttl.items():
+        for key, value in ttl_items:
+            sdmx_memory_cache.set(key, value, key_ttl)
+        sdmx_disk_cache.set_many(ttl_items, key_ttl)
+
+
+def get_stale_sdmx(key):
+    """
+    Looks up a parsed SDMX result on disk even if it expired (expired rows stay until evicted), to answer
+    while ISTAT is unavailable.
+
+    Returns:
+        The cached value, or None if it was never cached or was evicted.
+    """
+    global sdmx_stale_hits
+    entry = sdmx_disk_cache.get_entry(key, allow_stale=True)
+    if entry is None:
+        return None
+    sdmx_stale_hits += 1
+    return entry[0]
+
+
+def get_sdmx_cache_stats():
+    """ Returns the hit/miss counters of the SDMX cache together with the current in-memory size. """
+    lookups = sum(sdmx_cache_stats.values())
+    hits = sdmx_cache_stats["memory_hits"] + sdmx_cache_stats["disk_hits"]
+    return {
+        **sdmx_cache_stats,
+        "hit_ratio": hits / lookups if lookups else 0.0,
+        "stale_hits": sdmx_stale_hits,
+        "memory_entries": len(sdmx_memory_cache),
+    }
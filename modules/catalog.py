@@ -0,0 +1,175 @@
+import os
+import json
+import pickle
+import threading
+from functools import cached_property
+
+from modules.shared import *
+
+CATALOG_SNAPSHOT_PATH = config.get("CATALOG_SNAPSHOT_PATH", DATA_ISTAT_API_PATH + "/catalog.pickle")
+
+# Location files making up the locations offered to the LLM, in prompt order
+location_type_files = ['_geographic_areas', '_regions', '_provinces']
+
+# Provinces whose code does not start with the code of their region
+location_parent_overrides = {
+    "ITD10": "ITDA",  # Bolzano
+    "ITD20": "ITDA",  # Trento
+    "IT108": "ITC4",  # Monza e della Brianza
+    "IT109": "ITE3",  # Fermo
+    "IT110": "ITF4",  # Barletta-Andria-Trani
+    "IT111": "ITG2",  # Sud Sardegna
+}
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_parent_location_id(location_id):
+    """
+    Returns the ITTER107 id of the area, region or country containing a location (None for Italy and municipalities).
+
+    Example:
+        get_parent_location_id("ITD55") -> "ITD5", get_parent_location_id("ITDA") -> "ITD", get_parent_location_id("ITD") -> "IT"
+    """
+    if location_id in location_parent_overrides:
+        return location_parent_overrides[location_id]
+    if location_id == "IT" or not location_id.startswith("IT"):
+        return None
+    if len(location_id) == 3:
+        return "IT"
+    if len(location_id) == 4:
+        return location_id[:3]
+    return location_id[:4]
+
+
+class Catalog:
+    """
+    Geography and dataset metadata read from the data files at most once per process.
+
+    Every file and lookup is loaded on first use and memoized. `snapshot` pickles everything already
+    loaded, together with the modification times of its source files, so that new workers can start from
+    one binary read (see `get_catalog`).
+    """
+
+    def __init__(self, path=DATA_ISTAT_API_PATH):
+        self.path = path
+        self._records = {}
+        self._mtimes = {}
+
+    def records(self, file_name):
+        """ Returns the parsed lines of a JSONL file under the data folder (shared list: do not modify). """
+        records = self._records.get(file_name)
+        if records is None:
+            file_path = f"{self.path}/{file_name}"
+            with open(file_path, 'r', encoding='utf-8') as file:
+                records = [json.loads(line) for line in file]
+            self._records[file_name] = records
+            self._mtimes[file_name] = os.path.getmtime(file_path)
+        return records
+
+    def location_records(self, location_type):
+        return self.records(f"ITTER107/{location_type}.jsonl")
+
+    @cached_property
+    def locations(self):
+        """ Single-key {name: id} dictionaries of geographic areas, regions and provinces. """
+        return [item for location_type in location_type_files for item in self.location_records(location_type)]
+
+    @cached_property
+    def location_names(self):
+        """ {id: name} of geographic areas, regions and provinces. """
+        return {location_id: name for item in self.locations for name, location_id in item.items()}
+
+    @cached_property
+    def location_ids(self):
+        """ {name: id} of geographic areas, regions and provinces. """
+        return {name: location_id for item in self.locations for name, location_id in item.items()}
+
+    @cached_property
+    def location_children(self):
+        """ {id: [ids of the locations directly inside it]} over geographic areas, regions and provinces. """
+        children = {}
+        for item in self.locations:
+            for location_id in item.values():
+                parent_id = get_parent_location_id(location_id)
+                if parent_id is not None:
+                    children.setdefault(parent_id, []).append(location_id)
+        return children
+
+    @cached_property
+    def datasets(self):
+        """ {dataflow_id: dataset info} from useful_istat_datasets.jsonl ({} if the file was not generated). """
+        try:
+            return {row['dataflow_id']: row for row in self.records("useful_istat_datasets.jsonl")}
+        except IOError:
+            return {}
+
+    def load_all(self):
+        """ Loads every file and lookup, e.g. before taking a snapshot. """
+        for name in ("locations", "location_names", "location_ids", "location_children", "datasets"):
+            getattr(self, name)
+        return self
+
+    def is_fresh(self):
+        """ True if none of the loaded files changed on disk since they were read. """
+        for file_name, mtime in self._mtimes.items():
+            try:
+                if os.path.getmtime(f"{self.path}/{file_name}") != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def snapshot(self, file_path=CATALOG_SNAPSHOT_PATH):
+        """ Pickles the fully loaded catalog to `file_path` (written atomically). """
+        self.load_all()
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def from_snapshot(cls, file_path=CATALOG_SNAPSHOT_PATH):
+        """ Returns the catalog pickled at `file_path`, or None if it is missing, unreadable or stale. """
+        try:
+            with open(file_path, 'rb') as file:
+                catalog = pickle.load(file)
+        except (IOError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        return catalog if isinstance(catalog, cls) and catalog.is_fresh() else None
+
+
+def get_catalog():
+    """ Returns the process-wide catalog, starting from a fresh snapshot when one exists. """
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = Catalog.from_snapshot() or Catalog()
+    return _catalog
+
+
+def warm_catalog(write_snapshot=True):
+    """
+    Loads the whole catalog now (e.g. at worker startup) and, if no fresh snapshot exists yet, writes one
+    so that the next workers only need a single read.
+    """
+    catalog = get_catalog().load_all()
+    if write_snapshot and Catalog.from_snapshot() is None:
+        try:
+            catalog.snapshot()
+        except IOError as e:
+            print(f"An error occurred while writing the catalog snapshot: {e}")
+    return catalog
+
+
+def reset_catalog():
+    """ Drops the loaded catalog and its snapshot, after the data files have been regenerated. """
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+    try:
+        os.remove(CATALOG_SNAPSHOT_PATH)
+    except OSError:
+        pass
@@ -1,5 +1,17 @@
+import os
+import re
+import json
+import time
+import threading
+from types import SimpleNamespace
+
 from modules.shared import *
-from openai import AzureOpenAI
+from modules.cache import LRUCache
+from modules.metrics import record_token_usage
+from modules.singleflight import SingleFlight, AsyncSingleFlight
+from modules.municipalities import normalize_location_name
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI
 
 
 LLMs = {
@@ -36,9 +48,106 @@ def initialize_AzureOpenAI_llm(selection):  # istat
         "azure_endpoint": params["azure_endpoint"],
         "openai_api_version": params["openai_api_version"],
         "azure_deployment": params["azure_deployment"],
+        "selection": selection,
+    }
+
+
+#################################################
+####### pooled Azure OpenAI clients  ############
+#################################################
+# Connection pool limits and timeouts shared by every client in the registry, overridable from .env
+LLM_CLIENT_SETTINGS = {
+    "max_connections": int(config.get("LLM_MAX_CONNECTIONS", 20)),
+    "max_keepalive_connections": int(config.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 10)),
+    "keepalive_expiry": float(config.get("LLM_KEEPALIVE_EXPIRY", 120)),
+    "connect_timeout": float(config.get("LLM_CONNECT_TIMEOUT", 5)),
+    "read_timeout": float(config.get("LLM_READ_TIMEOUT", 60)),
+    "max_retries": int(config.get("LLM_MAX_RETRIES", 2)),
+}
+
+# Long-lived clients keyed by the `LLMs` selection, e.g. {"gpt4": {"sync": AzureOpenAI, "async": AsyncAzureOpenAI}}
+llm_clients = {}
+
+
+def _create_AzureOpenAI_clients(model_config, settings):
+    limits = httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(settings["read_timeout"], connect=settings["connect_timeout"])
+    client_params = {
+        "api_key": model_config["api_key"],
+        "azure_endpoint": model_config["azure_endpoint"],
+        "api_version": model_config["openai_api_version"],
+        "max_retries": settings["max_retries"],
+        "timeout": timeout,
+    }
+    return {
+        "sync": AzureOpenAI(**client_params, http_client=httpx.Client(limits=limits, timeout=timeout)),
+        "async": AsyncAzureOpenAI(**client_params, http_client=httpx.AsyncClient(limits=limits, timeout=timeout)),
     }
 
 
+def initialize_AzureOpenAI_clients(selections=None, **settings):
+    """
+    Creates the pooled sync and async Azure OpenAI clients once, so that every completion reuses
+    the same keep-alive connections instead of paying client construction and TLS setup again.
+
+    Args:
+        selections (list of str): The `LLMs` keys to create clients for. Default is every configured selection.
+        **settings: Overrides for `LLM_CLIENT_SETTINGS` (e.g. max_connections=50, read_timeout=30).
+
+    Returns:
+        dict: The client registry, keyed by selection.
+    """
+    client_settings = {**LLM_CLIENT_SETTINGS, **settings}
+    for selection in selections or LLMs:
+        if selection in llm_clients:
+            continue
+        model_config = LLMs.get(selection, {})
+        if not model_config.get("api_key") or not model_config.get("azure_endpoint"):
+            print(f"Skipping Azure OpenAI client '{selection}': missing configuration.")
+            continue
+        llm_clients[selection] = _create_AzureOpenAI_clients(model_config, client_settings)
+    return llm_clients
+
+
+def get_AzureOpenAI_client(model_config, kind="sync"):
+    """
+    Returns the pooled client for a model configuration, creating and registering it on first use.
+
+    Args:
+        model_config (dict): Configuration returned by `initialize_AzureOpenAI_llm`.
+        kind (str): "sync" for `AzureOpenAI` or "async" for `AsyncAzureOpenAI`.
+
+    Returns:
+        AzureOpenAI | AsyncAzureOpenAI: The long-lived client.
+    """
+    selection = model_config.get("selection") or model_config["azure_endpoint"]
+    if selection not in llm_clients:
+        llm_clients[selection] = _create_AzureOpenAI_clients(model_config, LLM_CLIENT_SETTINGS)
+    return llm_clients[selection][kind]
+
+
+async def close_AzureOpenAI_clients():
+    """ Closes the connection pools of every registered client (called on application shutdown). """
+    for clients in llm_clients.values():
+        clients["sync"].close()
+        await clients["async"].close()
+    llm_clients.clear()
+
+
+# Identical completions requested at the same time (e.g. the same prompt from several users) are sent once
+completion_flight = SingleFlight("completions")
+completion_flight_async = AsyncSingleFlight("completions_async")
+
+
+def _completion_flight_key(messages, model_config, temperature, max_tokens, tools, tool_choice):
+    return json.dumps([_completion_model(model_config), messages, temperature, max_tokens, tools, tool_choice],
+                      sort_keys=True, default=str)
+
+
 # Function to fetch chat completions from Azure OpenAI
 def get_chat_completion(messages, model_config, temperature=0, max_tokens=300, tools=None, tool_choice=None):
     """
@@ -53,13 +162,15 @@ def get_chat_completion(messages, model_config, temperature=0, max_tokens=300, t
         tool_choice (str): Strategy for choosing between enabled tools, defaulting to 'auto' which lets the system decide the best tool to use based on the context.
 
     Returns:
-        str: The content of the response message.
+        str: The content of the response message, shared with identical concurrent calls.
     """
-    client = AzureOpenAI(
-        api_key=model_config["api_key"],
-        azure_endpoint=model_config["azure_endpoint"],
-        api_version=model_config["openai_api_version"],
-    )
+    key = _completion_flight_key(messages, model_config, temperature, max_tokens, tools, tool_choice)
+    return completion_flight.do(key, _get_chat_completion, messages, model_config, temperature, max_tokens, tools,
+                                tool_choice)
+
+
+def _get_chat_completion(messages, model_config, temperature, max_tokens, tools, tool_choice):
+    client = get_AzureOpenAI_client(model_config, "sync")
     response = client.chat.completions.create(
         model=model_config["azure_deployment"],
         messages=messages,
@@ -68,4 +179,271 @@ def get_chat_completion(messages, model_config, temperature=0, max_tokens=300, t
         tools=tools,
         tool_choice=tool_choice,
     )
-    return response.choices[0].message
\ No newline at end of file
+    record_token_usage(response.usage)
+    return response.choices[0].message
+
+
+async def get_chat_completion_async(messages, model_config, temperature=0, max_tokens=300, tools=None, tool_choice=None):
+    """
+    Async variant of `get_chat_completion`: awaits the Azure OpenAI completion instead of blocking the event loop.
+
+    Args:
+        messages (list of dict): A list of messages in the chat with roles (system, user, assistant) and their respective content.
+        model_config (dict): Configuration of the deployment model, including api_key, endpoint, version, and deployment name.
+        temperature (float): Controls randomness in the response generation. Default is 0, indicating deterministic results.
+        max_tokens (int): Maximum number of tokens to generate in the response. Default is 300.
+        tools (list of str): Optional list of tools that can be enabled if supported by the deployment. Default is None.
+        tool_choice (str): Strategy for choosing between enabled tools.
+
+    Returns:
+        str: The content of the response message, shared with identical concurrent calls.
+    """
+    key = _completion_flight_key(messages, model_config, temperature, max_tokens, tools, tool_choice)
+    return await completion_flight_async.do(key, _get_chat_completion_async, messages, model_config, temperature,
+                                            max_tokens, tools, tool_choice)
+
+
+async def _get_chat_completion_async(messages, model_config, temperature, max_tokens, tools, tool_choice):
+    client = get_AzureOpenAI_client(model_config, "async")
+    response = await client.chat.completions.create(
+        model=model_config["azure_deployment"],
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        tools=tools,
+        tool_choice=tool_choice,
+    )
+    record_token_usage(response.usage)
+    return response.choices[0].message
+
+
+#################################################
+####### completion cache  #######################
+#################################################
+COMPLETION_CACHE_PATH = config.get("COMPLETION_CACHE_PATH", DATA_ISTAT_API_PATH + "/cache/completions.jsonl")
+# 0 disables the cache
+COMPLETION_CACHE_MAX_ENTRIES = int(config.get("COMPLETION_CACHE_MAX_ENTRIES", 10000))
+# Relative prompts ("the latest year") must eventually be answered again against new data
+COMPLETION_CACHE_TTL = int(config.get("COMPLETION_CACHE_TTL", 7 * 24 * 3600))
+# Trigram similarity above which a different phrasing reuses a cached completion. 0 (the default) allows exact
+# matches only: similar prompts can ask for different data, e.g. "population of Rome in 2023 by sex"
+COMPLETION_CACHE_MIN_SIMILARITY = float(config.get("COMPLETION_CACHE_MIN_SIMILARITY", 0))
+
+# Words that do not change the meaning of a data request, in English and Italian. Range and conjunction words
+# ("2020 to 2023" vs "2020 and 2023") do, and are kept as the "to" and "and" tokens of `prompt_synonyms`
+prompt_filler_words = {
+    "a", "an", "the", "of", "in", "at", "on", "for", "is", "are", "was", "what", "which", "how", "many",
+    "much", "tell", "me", "show", "give", "please", "can", "you", "i", "want", "know", "there",
+    "di", "del", "della", "dello", "dei", "degli", "delle", "nel", "nella", "nei", "alla",
+    "il", "lo", "la", "gli", "le", "un", "una", "qual", "quale", "sono", "era", "quanti", "quante", "quanto",
+    "dimmi", "mostrami", "vorrei", "sapere", "per", "favore", "mi", "ci",
+}
+
+# Equivalent words mapped to one spelling, so that they normalize to the same prompt
+prompt_synonyms = {
+    "popolazione": "population", "abitanti": "population", "inhabitants": "population", "residents": "population",
+    "residenti": "population", "people": "population",
+    "maschi": "male", "males": "male", "men": "male", "uomini": "male", "maschile": "male",
+    "femmine": "female", "females": "female", "women": "female", "donne": "female", "femminile": "female",
+    "anni": "years", "anno": "year", "tra": "between", "fra": "between", "dal": "from", "al": "to", "fino": "until",
+    "e": "and", "ed": "and", "through": "to",
+    "sopra": "over", "oltre": "over", "sotto": "under", "rome": "roma", "milan": "milano", "naples": "napoli",
+    "turin": "torino", "florence": "firenze", "venice": "venezia", "genoa": "genova",
+}
+
+# Words whose difference always changes the answer, compared exactly before any similarity lookup
+_guard_words = {"male", "female", "over", "under", "between", "from", "until", "to", "and", "young", "old", "older",
+                "younger"}
+
+completion_cache = LRUCache(COMPLETION_CACHE_MAX_ENTRIES or 1)
+completion_cache_stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+_completion_cache_groups = {}
+_completion_cache_lock = threading.Lock()
+_completion_cache_loaded = False
+_completion_cache_log_lines = 0
+
+
+def normalize_prompt(prompt):
+    """
+    Normalizes a user prompt for the completion cache: accents, punctuation, filler words and synonyms are removed.
+
+    Example:
+        normalize_prompt("What is the population of Roma in 2023?") -> "population roma 2023"
+        normalize_prompt("Popolazione di Roma 2023") -> "population roma 2023"
+        normalize_prompt("Popolazione di Roma 2020-2023") -> "population roma 2020 to 2023"
+    """
+    # A dash between two numbers is a range, not punctuation
+    prompt = re.sub(r'(\d)\s*-\s*(\d)', r'\1 to \2', prompt)
+    tokens = (prompt_synonyms.get(token, token) for token in normalize_location_name(prompt).split())
+    return " ".join(token for token in tokens if token not in prompt_filler_words)
+
+
+def _prompt_guard(normalized_prompt, signature):
+    """ Numbers, sex and age words and `signature`: a similar prompt reuses a completion only if they are identical. """
+    tokens = normalized_prompt.split()
+    numbers = [token for token in tokens if any(char.isdigit() for char in token)]
+    words = sorted({token for token in tokens if token in _guard_words})
+    return json.dumps([numbers, words, signature or ""])
+
+
+def _prompt_similarity(a, b):
+    trigrams_a = {f" {a} "[i:i + 3] for i in range(len(a))}
+    trigrams_b = {f" {b} "[i:i + 3] for i in range(len(b))}
+    union = trigrams_a | trigrams_b
+    return len(trigrams_a & trigrams_b) / len(union) if union else 0.0
+
+
+def _completion_model(model_config):
+    return model_config.get("selection") or model_config.get("azure_deployment")
+
+
+def _completion_cache_key(normalized_prompt, model_config):
+    return json.dumps([_completion_model(model_config), normalized_prompt])
+
+
+def _add_completion_entry(key, entry, ttl):
+    completion_cache.set(key, entry, ttl)
+    _completion_cache_groups.setdefault(entry["guard"], set()).add(key)
+    # Keys evicted from the LRU stay in their group until the groups are rebuilt
+    if sum(len(keys) for keys in _completion_cache_groups.values()) > 2 * COMPLETION_CACHE_MAX_ENTRIES:
+        _completion_cache_groups.clear()
+        for cached_key, cached_entry, _ in completion_cache.items():
+            _completion_cache_groups.setdefault(cached_entry["guard"], set()).add(cached_key)
+
+
+def load_completion_cache(file_path=None):
+    """
+    Loads the persisted completions (once per process) and rewrites the file without expired or
+    superseded entries.
+    """
+    global _completion_cache_loaded
+    file_path = file_path or COMPLETION_CACHE_PATH
+    with _completion_cache_lock:
+        if _completion_cache_loaded:
+            return
+        _completion_cache_loaded = True
+        now = time.time()
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record["expires_at"] > now:
+                        _add_completion_entry(record["key"], record["entry"], record["expires_at"] - now)
+        except IOError:
+            return
+        _compact_completion_cache(file_path)
+
+
+def _compact_completion_cache(file_path):
+    global _completion_cache_log_lines
+    records = [{"key": key, "entry": entry, "expires_at": expires_at} for key, entry, expires_at in completion_cache.items()]
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, file_path)
+    except IOError as e:
+        print(f"An error occurred while writing the completion cache: {e}")
+        return
+    _completion_cache_log_lines = len(records)
+
+
+def get_cached_completion(prompt, model_config, signature=None):
+    """
+    Looks up the tool calls chosen for the same request before, so that the LLM can be skipped entirely.
+
+    The prompt is matched exactly after `normalize_prompt`, then, if COMPLETION_CACHE_MIN_SIMILARITY is set, by
+    trigram similarity among the cached prompts with the same numbers, sex and age words and `signature`.
+
+    Args:
+        prompt (str): The user prompt.
+        model_config (dict): Configuration returned by `initialize_AzureOpenAI_llm`.
+        signature (str): Optional extra value that a similar prompt must share, e.g. the locations resolved locally.
+
+    Returns:
+        The cached completion message (with `content` and `tool_calls`, like `get_chat_completion`), or None on a miss.
+    """
+    if not COMPLETION_CACHE_MAX_ENTRIES:
+        return None
+    load_completion_cache()
+    normalized = normalize_prompt(prompt)
+    entry = completion_cache.get(_completion_cache_key(normalized, model_config))
+    if entry is not None:
+        completion_cache_stats["exact_hits"] += 1
+        return _cached_completion_message(entry)
+    if COMPLETION_CACHE_MIN_SIMILARITY > 0:
+        model = _completion_model(model_config)
+        best_similarity, best_entry = COMPLETION_CACHE_MIN_SIMILARITY, None
+        for key in list(_completion_cache_groups.get(_prompt_guard(normalized, signature), ())):
+            cached_model, cached_prompt = json.loads(key)
+            if cached_model != model:
+                continue
+            similarity = _prompt_similarity(normalized, cached_prompt)
+            if similarity >= best_similarity:
+                candidate = completion_cache.get(key)
+                if candidate is not None:
+                    best_similarity, best_entry = similarity, candidate
+        if best_entry is not None:
+            completion_cache_stats["similar_hits"] += 1
+            return _cached_completion_message(best_entry)
+    completion_cache_stats["misses"] += 1
+    return None
+
+
+def set_cached_completion(prompt, model_config, tool_calls, signature=None, ttl=COMPLETION_CACHE_TTL):
+    """
+    Caches the tool calls answering a prompt, in memory and appended to COMPLETION_CACHE_PATH.
+
+    Args:
+        prompt (str): The user prompt.
+        model_config (dict): Configuration returned by `initialize_AzureOpenAI_llm`.
+        tool_calls (list of tuple): (tool name, arguments dict) pairs, e.g. the validated calls of `run_tool_calls`.
+        signature (str): The same signature later passed to `get_cached_completion`.
+        ttl (int): Seconds before the entry expires.
+    """
+    global _completion_cache_log_lines
+    if not COMPLETION_CACHE_MAX_ENTRIES or not tool_calls:
+        return
+    load_completion_cache()
+    normalized = normalize_prompt(prompt)
+    key = _completion_cache_key(normalized, model_config)
+    entry = {
+        "guard": _prompt_guard(normalized, signature),
+        "tool_calls": [{"name": name, "arguments": arguments} for name, arguments in tool_calls],
+    }
+    record = {"key": key, "entry": entry, "expires_at": time.time() + ttl}
+    with _completion_cache_lock:
+        _add_completion_entry(key, entry, ttl)
+        try:
+            os.makedirs(os.path.dirname(COMPLETION_CACHE_PATH), exist_ok=True)
+            with open(COMPLETION_CACHE_PATH, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            _completion_cache_log_lines += 1
+        except IOError as e:
+            print(f"An error occurred while writing the completion cache: {e}")
+        if _completion_cache_log_lines > 2 * COMPLETION_CACHE_MAX_ENTRIES:
+            _compact_completion_cache(COMPLETION_CACHE_PATH)
+
+
+def _cached_completion_message(entry):
+    """ Rebuilds a completion message whose `tool_calls` have the shape of the OpenAI ones. """
+    return SimpleNamespace(content=None, tool_calls=[
+        SimpleNamespace(id=f"cached_{index}", type="function",
+                        function=SimpleNamespace(name=tool_call["name"], arguments=json.dumps(tool_call["arguments"])))
+        for index, tool_call in enumerate(entry["tool_calls"])
+    ])
+
+
+def get_completion_cache_stats():
+    """ Returns the hit/miss counters of the completion cache together with its current size. """
+    lookups = sum(completion_cache_stats.values())
+    hits = completion_cache_stats["exact_hits"] + completion_cache_stats["similar_hits"]
+    return {
+        **completion_cache_stats,
+        "hit_ratio": hits / lookups if lookups else 0.0,
+        "entries": len(completion_cache),
+    }
@@ -0,0 +1,274 @@
+from collections import defaultdict
+
+from modules.shared import *
+from modules.municipalities import *
+from modules.utils import assemble_locations
+
+# Below this confidence the caller should fall back to the LLM location prompt
+LOCATION_RESOLVER_MIN_CONFIDENCE = float(config.get("LOCATION_RESOLVER_MIN_CONFIDENCE", 0.85))
+
+# Alternative spellings (English names, common short forms) mapped to the Italian names of the ITTER107 files
+location_aliases = {
+    "italy": "Italia",
+    "south italy": "Sud",
+    "southern italy": "Sud",
+    "sud italia": "Sud",
+    "italia meridionale": "Sud",
+    "mezzogiorno": "Sud",
+    "central italy": "Centro",
+    "centro italia": "Centro",
+    "italia centrale": "Centro",
+    "north east": "Nord-est",
+    "northeast": "Nord-est",
+    "north eastern italy": "Nord-est",
+    "north west": "Nord-ovest",
+    "northwest": "Nord-ovest",
+    "north western italy": "Nord-ovest",
+    "islands": "Isole",
+    "italian islands": "Isole",
+    "isole italiane": "Isole",
+    "sicily": "Sicilia",
+    "sardinia": "Sardegna",
+    "lombardy": "Lombardia",
+    "tuscany": "Toscana",
+    "piedmont": "Piemonte",
+    "apulia": "Puglia",
+    "aosta valley": "Valle d'Aosta",
+    "trentino": "Trentino Alto Adige",
+    "trentino south tyrol": "Trentino Alto Adige",
+    "friuli": "Friuli-Venezia Giulia",
+    "rome": "Roma",
+    "milan": "Milano",
+    "naples": "Napoli",
+    "turin": "Torino",
+    "florence": "Firenze",
+    "venice": "Venezia",
+    "genoa": "Genova",
+    "padua": "Padova",
+    "mantua": "Mantova",
+    "syracuse": "Siracusa",
+    "bozen": "Bolzano",
+    "reggio calabria": "Reggio di Calabria",
+    "reggio emilia": "Reggio nell'Emilia",
+    "monza": "Monza e della Brianza",
+    "monza brianza": "Monza e della Brianza",
+    "pesaro": "Pesaro e Urbino",
+}
+
+# Names that are also ordinary words in a prompt ("il centro di Roma"): matched with reduced confidence
+ambiguous_location_names = {"centro", "sud", "isole"}
+
+# Words never used as the start of a fuzzy match
+_stopwords = {
+    "the", "of", "in", "and", "for", "what", "which", "how", "many", "tell", "me", "population", "people",
+    "male", "female", "males", "females", "total", "years", "year", "between", "from", "until", "under", "over",
+    "di", "del", "della", "dei", "delle", "e", "ed", "per", "nel", "nella", "la", "il", "le", "gli",
+    "quanti", "quante", "popolazione", "abitanti", "maschi", "femmine", "anni", "anno",
+}
+
+# Single-word municipality names that are also common words ("il paese di Cesena", "cento anni")
+common_word_municipalities = {
+    "paese", "mese", "cento", "zone", "sale", "nave", "ponte", "ponti", "porte", "scala", "vita", "cave", "mura",
+    "campagna", "massa", "fondi", "lettere", "stella", "monti", "castelli", "grotte", "arena", "rose", "viola",
+    "mele", "amaro", "lenta", "sorso", "sacco", "tufo", "mira", "scanno", "noto", "vasto", "calci", "cervo",
+    "bella", "carpi", "limone", "mori", "dolo", "mattinata", "vallata",
+}
+
+# Words that introduce a place right before its name ("abitanti di Sale", "population of Cento")
+location_cue_words = {"di", "a", "ad", "of", "in"}
+
+# Confidence of a municipality matched by its exact name, of a name shared by several municipalities,
+# and of a common word not introduced by a cue word (below LOCATION_RESOLVER_MIN_CONFIDENCE, left to the LLM)
+MUNICIPALITY_MATCH_CONFIDENCE = 0.95
+HOMONYM_MUNICIPALITY_CONFIDENCE = 0.7
+COMMON_WORD_MUNICIPALITY_CONFIDENCE = 0.6
+
+_location_index = None
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a, b, max_distance):
+    """ Levenshtein distance between `a` and `b`, or `max_distance + 1` as soon as it is exceeded. """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def build_location_index(locations=None):
+    """
+    Builds the in-memory index used by `resolve_location_ids`.
+
+    Args:
+        locations (list of dict): Single-key {name: id} dictionaries. Default is `assemble_locations()`.
+
+    Returns:
+        dict: {"names": {normalized name: (id, confidence)}, "trigrams": {trigram: set of names}, "max_words": int}
+    """
+    if locations is None:
+        locations = assemble_locations()
+    names = {}
+    ids_by_name = {}
+    for item in locations:
+        name, location_id = next(iter(item.items()))
+        normalized = normalize_location_name(name)
+        ids_by_name[name] = location_id
+        names[normalized] = (location_id, 0.7 if normalized in ambiguous_location_names else 1.0)
+    for alias, name in location_aliases.items():
+        if name in ids_by_name:
+            names.setdefault(alias, (ids_by_name[name], 1.0))
+    trigrams = defaultdict(set)
+    for normalized in names:
+        for trigram in _trigrams(normalized):
+            trigrams[trigram].add(normalized)
+    return {
+        "names": names,
+        "trigrams": trigrams,
+        "max_words": max(len(normalized.split()) for normalized in names),
+    }
+
+
+def get_location_index():
+    global _location_index
+    if _location_index is None:
+        _location_index = build_location_index()
+    return _location_index
+
+
+def _municipality_lookup(phrase, previous_token=None):
+    """
+    Returns (code, confidence) of the municipality named exactly `phrase`, or None.
+    Short single words and stopwords are skipped: municipalities like "Re" or "Ora" are also ordinary words.
+    Longer names that are also common words ("Paese", "Cento") only get a low confidence, unless the word
+    before them is a cue such as "di" or "of".
+    """
+    if phrase in _stopwords or (" " not in phrase and len(phrase) < 4):
+        return None
+    codes = find_municipality_codes(phrase)
+    if not codes:
+        return None
+    if phrase in common_word_municipalities and previous_token not in location_cue_words:
+        return codes[0], COMMON_WORD_MUNICIPALITY_CONFIDENCE
+    return codes[0], MUNICIPALITY_MATCH_CONFIDENCE if len(codes) == 1 else HOMONYM_MUNICIPALITY_CONFIDENCE
+
+
+def _fuzzy_lookup(phrase, index):
+    """ Returns (id, confidence) of the closest indexed name within a small edit distance, or None. """
+    if len(phrase) < 5:
+        return None
+    max_distance = 1 if len(phrase) < 8 else 2
+    phrase_trigrams = _trigrams(phrase)
+    candidates = defaultdict(int)
+    for trigram in phrase_trigrams:
+        for name in index["trigrams"].get(trigram, ()):
+            candidates[name] += 1
+    best = None
+    for name, shared in candidates.items():
+        if shared < len(phrase_trigrams) // 2:
+            continue
+        distance = _edit_distance(phrase, name, max_distance)
+        if distance <= max_distance:
+            location_id, confidence = index["names"][name]
+            score = confidence * (1 - distance / max(len(name), len(phrase)))
+            if best is None or score > best[1]:
+                best = (location_id, score)
+    return best
+
+
+def location_candidates(prompt, limit=10, min_similarity=0.4, index=None):
+    """
+    Returns the ids of the indexed locations whose names look most like some words of the prompt,
+    best first: a loose pre-filter for the LLM location prompt, not a resolution.
+
+    Example:
+        location_candidates("population of Bolgna") -> ['ITD55', ...]
+    """
+    if index is None:
+        index = get_location_index()
+    tokens = [token for token in normalize_location_name(prompt).split() if token not in _stopwords]
+    scores = {}
+    for width in range(1, index["max_words"] + 1):
+        for position in range(len(tokens) - width + 1):
+            phrase_trigrams = _trigrams(" ".join(tokens[position:position + width]))
+            candidates = defaultdict(int)
+            for trigram in phrase_trigrams:
+                for name in index["trigrams"].get(trigram, ()):
+                    candidates[name] += 1
+            for name, shared in candidates.items():
+                similarity = shared / len(phrase_trigrams | _trigrams(name))
+                location_id = index["names"][name][0]
+                if similarity >= min_similarity and similarity > scores.get(location_id, 0):
+                    scores[location_id] = similarity
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+def resolve_location_ids(prompt, index=None):
+    """
+    Resolves the place names mentioned in a prompt to ITTER107 ids without calling the LLM.
+
+    Names are matched longest-first on the normalized prompt, exactly (accents and punctuation ignored)
+    and then fuzzily (trigram candidates checked by edit distance) to absorb typos like "Bolgna".
+    Municipalities are matched exactly through the on-disk municipality index; areas, regions and provinces
+    take precedence over municipalities of the same name ("Bologna" is the province).
+
+    Args:
+        prompt (str): The user prompt.
+        index (dict): Index built by `build_location_index`. Default is the shared index.
+
+    Returns:
+        tuple: (location_ids, confidence) where location_ids are the matched ids combined with '+'
+               (None if nothing matched) and confidence is the lowest score among the matches (0 to 1).
+
+    Example:
+        resolve_location_ids("What is the population of Bologna, Ravenna and Parma?") -> ("ITD55+ITD57+ITD52", 1.0)
+    """
+    if index is None:
+        index = get_location_index()
+    tokens = normalize_location_name(prompt).split()
+    max_words = max(index["max_words"], get_municipality_max_words())
+    matches = []
+    position = 0
+    while position < len(tokens):
+        match = None
+        widths = range(min(max_words, len(tokens) - position), 0, -1)
+        for width in widths:
+            phrase = " ".join(tokens[position:position + width])
+            if phrase in index["names"]:
+                match = (width, *index["names"][phrase])
+                break
+            municipality = _municipality_lookup(phrase, tokens[position - 1] if position else None)
+            if municipality:
+                match = (width, *municipality)
+                break
+        if match is None and tokens[position] not in _stopwords and not tokens[position].isdigit():
+            # Fuzzy matching only covers areas, regions and provinces
+            for width in range(min(index["max_words"], len(tokens) - position), 0, -1):
+                fuzzy = _fuzzy_lookup(" ".join(tokens[position:position + width]), index)
+                if fuzzy:
+                    match = (width, *fuzzy)
+                    break
+        if match is None:
+            position += 1
+            continue
+        width, location_id, confidence = match
+        matches.append((location_id, confidence))
+        position += width
+    location_ids = list(dict.fromkeys(location_id for location_id, _ in matches))
+    # "Palermo, Italy" asks for Palermo: the country only counts when it is the only location
+    if len(location_ids) > 1 and "IT" in location_ids:
+        location_ids.remove("IT")
+    if not location_ids:
+        return None, 0.0
+    confidence = min(confidence for location_id, confidence in matches if location_id in location_ids)
+    return "+".join(location_ids), confidence
@@ -0,0 +1,148 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds of the histogram buckets (the last bucket is unbounded)
+STAGE_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Metrics of the request being processed: {"started_at", "stages": {stage: ms}, "tokens": {...}}
+current_request_metrics = contextvars.ContextVar("current_request_metrics", default=None)
+
+
+class Histogram:
+    """ Thread-safe fixed-bucket histogram of durations in milliseconds. """
+
+    def __init__(self, buckets=STAGE_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile (the maximum for the unbounded bucket). """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum_ms": round(self.sum, 3),
+                "mean_ms": round(self.sum / self.count, 3) if self.count else 0.0,
+                "max_ms": round(self.max, 3),
+                "p50_ms": self.quantile(0.5),
+                "p95_ms": self.quantile(0.95),
+                "buckets": {f"le_{bound}": count for bound, count in zip(self.buckets, self.counts)}
+                           | {"inf": self.counts[-1]},
+            }
+
+
+stage_histograms = {}
+token_counters = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+_metrics_lock = threading.Lock()
+
+
+def _observe_stage(stage, milliseconds):
+    histogram = stage_histograms.get(stage)
+    if histogram is None:
+        with _metrics_lock:
+            histogram = stage_histograms.setdefault(stage, Histogram())
+    histogram.observe(milliseconds)
+
+
+def start_request_metrics():
+    """ Starts collecting the stages and token usage of the current request (one context per request). """
+    metrics = {
+        "started_at": time.perf_counter(),
+        "stages": {},
+        "tokens": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+    current_request_metrics.set(metrics)
+    return metrics
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Measures the wall time of a block as `stage`. Inside a request the time is added to the request's
+    total for that stage (a stage may run several times, e.g. once per streamed chunk) and observed when
+    the request finishes; outside a request it is observed right away.
+
+    Example:
+        with timed_stage("tool_llm"):
+            response = await get_chat_completion_async(messages, llm, tools=tools)
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started_at) * 1000
+        metrics = current_request_metrics.get()
+        if metrics is None:
+            _observe_stage(stage, elapsed)
+        else:
+            metrics["stages"][stage] = metrics["stages"].get(stage, 0.0) + elapsed
+
+
+def record_token_usage(usage):
+    """ Adds the `usage` of a chat completion response (prompt, completion and total tokens) to the counters. """
+    if usage is None:
+        return
+    counts = {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "total_tokens": usage.total_tokens or 0,
+    }
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        for key, value in counts.items():
+            metrics["tokens"][key] += value
+    with _metrics_lock:
+        for key, value in counts.items():
+            token_counters[key] += value
+
+
+def finish_request_metrics():
+    """
+    Closes the current request: observes its stage totals and its overall duration ("request").
+
+    Returns:
+        dict: {"duration_ms": float, "stages": {stage: ms}, "tokens": {...}}, or None outside a request.
+    """
+    metrics = current_request_metrics.get()
+    if metrics is None:
+        return None
+    duration = (time.perf_counter() - metrics["started_at"]) * 1000
+    for stage, milliseconds in metrics["stages"].items():
+        _observe_stage(stage, milliseconds)
+    _observe_stage("request", duration)
+    with _metrics_lock:
+        token_counters["requests"] += 1
+    current_request_metrics.set(None)
+    return {"duration_ms": round(duration, 3), "stages": metrics["stages"], "tokens": metrics["tokens"]}
+
+
+def get_metrics():
+    """ Returns the per-stage duration histograms and the cumulative token counters. """
+    return {
+        "stages": {stage: histogram.snapshot() for stage, histogram in sorted(stage_histograms.items())},
+        "tokens": dict(token_counters),
+    }
@@ -0,0 +1,144 @@
+import os
+import re
+import mmap
+import json
+import threading
+import unicodedata
+
+from modules.shared import *
+
+MUNICIPALITIES_BY_NAME_PATH = DATA_ISTAT_API_PATH + "/ITTER107/_municipalities_by_name.idx"
+MUNICIPALITIES_BY_CODE_PATH = DATA_ISTAT_API_PATH + "/ITTER107/_municipalities_by_code.idx"
+
+_municipality_indexes = {}
+_municipality_indexes_lock = threading.Lock()
+
+
+def normalize_location_name(text):
+    """
+    Normalizes a place name or prompt for matching: lowercase, accents stripped and punctuation turned into spaces.
+
+    Example:
+        normalize_location_name("Forlì-Cesena") -> "forli cesena"
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", text.lower()).split())
+
+
+class SortedKeyFile:
+    """
+    Read-only "key<TAB>value" lines sorted by key, memory-mapped and searched by bisection.
+
+    Lookups cost O(log n) page reads and nothing is loaded up front, so resident memory does not
+    grow with the number of entries. The first line is a header whose second field is stored in `meta`.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self._data.find(b"\n") + 1
+        self.meta = self._data[:header_end].rstrip(b"\n").split(b"\t")[1].decode('utf-8')
+        self._start = header_end
+
+    @staticmethod
+    def write(path, items, meta=""):
+        """ Writes (key, value) string pairs as a sorted key file, atomically. """
+        lines = sorted(f"{key}\t{value}\n".encode('utf-8') for key, value in items)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(f"#\t{meta}\n".encode('utf-8'))
+            file.writelines(lines)
+        os.replace(tmp_path, path)
+
+    def _lower_bound(self, key):
+        """ Offset of the first line whose key is >= `key`. """
+        low, high = self._start, len(self._data)
+        while low < high:
+            middle = (low + high) // 2
+            line_start = self._data.rfind(b"\n", self._start - 1, middle) + 1
+            line_end = self._data.find(b"\n", line_start)
+            if self._data[line_start:line_end].split(b"\t", 1)[0] < key:
+                low = line_end + 1
+            else:
+                high = line_start
+        return low
+
+    def lookup(self, key):
+        """ Returns the values of every line with exactly this key. """
+        key = key.encode('utf-8')
+        values = []
+        position = self._lower_bound(key)
+        while position < len(self._data):
+            line_end = self._data.find(b"\n", position)
+            line_key, value = self._data[position:line_end].split(b"\t", 1)
+            if line_key != key:
+                break
+            values.append(value.decode('utf-8'))
+            position = line_end + 1
+        return values
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+
+def build_municipality_index(municipalities=None):
+    """
+    Writes the two municipality index files: normalized name -> code and code -> Italian name.
+
+    Args:
+        municipalities (list of dict): Single-key {name: code} dictionaries. Default is the content of
+            ITTER107/_municipalities.jsonl.
+
+    Returns:
+        None: Prints a message when the index has been saved.
+    """
+    if municipalities is None:
+        with open(f"{DATA_ISTAT_API_PATH}/ITTER107/_municipalities.jsonl", 'r', encoding='utf-8') as file:
+            municipalities = [json.loads(line) for line in file]
+    pairs = [next(iter(item.items())) for item in municipalities]
+    pairs = [(name, code) for name, code in pairs if name]
+    names = [(normalize_location_name(name), code) for name, code in pairs]
+    max_words = max((len(normalized.split()) for normalized, _ in names), default=0)
+    SortedKeyFile.write(MUNICIPALITIES_BY_NAME_PATH, names, meta=str(max_words))
+    SortedKeyFile.write(MUNICIPALITIES_BY_CODE_PATH, [(code, name) for name, code in pairs])
+    with _municipality_indexes_lock:
+        for index in _municipality_indexes.values():
+            if index is not None:
+                index.close()
+        _municipality_indexes.clear()
+    print(f"Municipality index saved for {len(pairs)} municipalities")
+
+
+def _get_index(path):
+    with _municipality_indexes_lock:
+        if path not in _municipality_indexes:
+            _municipality_indexes[path] = SortedKeyFile(path) if os.path.exists(path) else None
+        return _municipality_indexes[path]
+
+
+def find_municipality_codes(normalized_name):
+    """
+    Returns the codes of the municipalities with this normalized name (several for homonyms such as "Calliano").
+
+    Example:
+        find_municipality_codes("cesena") -> ['040007']
+    """
+    index = _get_index(MUNICIPALITIES_BY_NAME_PATH)
+    return index.lookup(normalized_name) if index is not None else []
+
+
+def get_municipality_name(code):
+    """ Returns the Italian name of a municipality code, or None if it is unknown or no index was built. """
+    index = _get_index(MUNICIPALITIES_BY_CODE_PATH)
+    if index is None:
+        return None
+    names = index.lookup(code)
+    return names[0] if names else None
+
+
+def get_municipality_max_words():
+    """ Number of words in the longest municipality name (0 if no index was built). """
+    index = _get_index(MUNICIPALITIES_BY_NAME_PATH)
+    return int(index.meta) if index is not None else 0
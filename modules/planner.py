@@ -0,0 +1,92 @@
+from modules.shared import *
+
+# Budgets of a single data query: URL length, and series it may return (locations x sexes x ages x years)
+SDMX_MAX_URL_LENGTH = int(config.get("SDMX_MAX_URL_LENGTH", 2000))
+SDMX_MAX_SERIES_PER_QUERY = int(config.get("SDMX_MAX_SERIES_PER_QUERY", 5000))
+# Chunks of one request downloaded at the same time
+SDMX_MAX_PARALLEL_QUERIES = int(config.get("SDMX_MAX_PARALLEL_QUERIES", 4))
+# A dimension requested for at least this share of its codes is left empty in the key (all codes) and filtered locally
+SDMX_WILDCARD_MIN_SHARE = float(config.get("SDMX_WILDCARD_MIN_SHARE", 0.6))
+
+# Number of codes of the SEX (1, 2, 9) and ETA1 (Y0..Y99, Y_GE100, TOTAL) dimensions of the population dataflow
+population_dimension_sizes = {"sex": 3, "age": 102}
+
+
+def population_data_url(dataflow, location_ids, sexes, ages, start_year, end_year):
+    """ Builds a data URL; an empty code list leaves its dimension empty, i.e. every code. """
+    return (f"https://esploradati.istat.it/SDMXWS/rest/data/IT1,{dataflow},1.0/"
+            f"A.{'+'.join(location_ids)}.JAN.{'+'.join(sexes)}.{'+'.join(ages)}.99/ALL/"
+            f"?detail=full&startPeriod={start_year}-01-01&endPeriod={end_year}-12-31&dimensionAtObservation=TIME_PERIOD")
+
+
+def _pack_codes(codes, max_length, max_codes):
+    """ Splits codes into consecutive groups whose '+'-joined length and size stay within the budgets. """
+    groups = []
+    group, length = [], 0
+    for code in codes:
+        added = len(code) + (1 if group else 0)
+        if group and (length + added > max_length or len(group) >= max_codes):
+            groups.append(group)
+            group, length = [], 0
+            added = len(code)
+        group.append(code)
+        length += added
+    if group:
+        groups.append(group)
+    return groups
+
+
+def plan_population_queries(missing, dataflow, max_url_length=None, max_series=None):
+    """
+    Plans the data queries fetching a set of (location, sex, age, year) series.
+
+    Sexes and ages requested for most of their codes are wildcarded, which keeps URLs short and lets ISTAT
+    serve the whole dimension; the extra series are cached as well. The locations (and, when they are too
+    many for one URL, the ages) are then split into chunks within `max_url_length` characters and
+    `max_series` series per query.
+
+    Args:
+        missing (list of tuple): The series to fetch.
+        dataflow (str): The dataflow id.
+        max_url_length (int): Default is SDMX_MAX_URL_LENGTH.
+        max_series (int): Default is SDMX_MAX_SERIES_PER_QUERY.
+
+    Returns:
+        list of dict: One query per chunk, in request order: {"url", "series" (the missing series it covers)}.
+    """
+    max_url_length = max_url_length or SDMX_MAX_URL_LENGTH
+    max_series = max_series or SDMX_MAX_SERIES_PER_QUERY
+    location_ids = list(dict.fromkeys(series_key[0] for series_key in missing))
+    sexes = list(dict.fromkeys(series_key[1] for series_key in missing))
+    ages = list(dict.fromkeys(series_key[2] for series_key in missing))
+    years = [int(series_key[3]) for series_key in missing]
+    start_year, end_year = min(years), max(years)
+
+    wildcard_sex = len(sexes) >= SDMX_WILDCARD_MIN_SHARE * population_dimension_sizes["sex"]
+    wildcard_age = len(ages) >= SDMX_WILDCARD_MIN_SHARE * population_dimension_sizes["age"]
+    sex_codes = [] if wildcard_sex else sexes
+    free_length = max_url_length - len(population_data_url(dataflow, [], sex_codes, [], start_year, end_year))
+    longest_location = max(len(location_id) for location_id in location_ids)
+    # Ages get at most half of the URL, the rest is left to the locations
+    age_groups = [[]] if wildcard_age else _pack_codes(ages, max(free_length // 2, len(max(ages, key=len))), len(ages))
+
+    plans = []
+    # (location, age) -> plan; age is None when the ages are wildcarded
+    plan_index = {}
+    for age_group in age_groups:
+        age_length = len("+".join(age_group))
+        series_per_location = ((population_dimension_sizes["sex"] if wildcard_sex else len(sexes))
+                               * (population_dimension_sizes["age"] if wildcard_age else len(age_group))
+                               * (end_year - start_year + 1))
+        location_groups = _pack_codes(location_ids, max(free_length - age_length, longest_location),
+                                      max(1, max_series // series_per_location))
+        for location_group in location_groups:
+            plan = {"url": population_data_url(dataflow, location_group, sex_codes, age_group, start_year, end_year),
+                    "series": []}
+            plans.append(plan)
+            for location_id in location_group:
+                for age in age_group or [None]:
+                    plan_index[(location_id, age)] = plan
+    for series_key in missing:
+        plan_index[(series_key[0], None if wildcard_age else series_key[2])]["series"].append(series_key)
+    return plans
@@ -0,0 +1,100 @@
+import math
+
+from modules.shared import *
+from modules.catalog import *
+from modules.locations import location_candidates
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Maximum tokens of the location list sent to the LLM with each request
+LOCATION_PROMPT_TOKEN_BUDGET = int(config.get("LOCATION_PROMPT_TOKEN_BUDGET", 1000))
+# Tokenizer used when tiktoken is installed (cl100k_base is the GPT-4 family encoding)
+TOKENIZER_ENCODING = config.get("TOKENIZER_ENCODING", "cl100k_base")
+
+_encoding = None
+_full_location_prompt = None
+
+
+def count_tokens(text):
+    """ Counts the tokens of a text with tiktoken when it is installed, otherwise estimates 4 characters per token. """
+    global _encoding
+    if tiktoken is None:
+        return math.ceil(len(text) / 4)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    return len(_encoding.encode(text))
+
+
+def encode_locations(include=None, catalog=None):
+    """
+    Encodes the locations as compact hierarchical lines, one per region with its provinces:
+
+        IT Italia
+        ITC Nord-ovest
+        ITC1 Piemonte: ITC11 Torino, ITC12 Vercelli, ...
+
+    Args:
+        include (set): Provinces to list. Default is None for all of them; areas and regions are always listed.
+        catalog (Catalog): Default is the shared catalog.
+
+    Returns:
+        str: The encoded locations.
+    """
+    catalog = catalog or get_catalog()
+    names = catalog.location_names
+    children = catalog.location_children
+    lines = ["IT " + names["IT"]]
+    for area_id in sorted(children.get("IT", [])):
+        lines.append(f"{area_id} {names[area_id]}")
+        for region_id in sorted(children.get(area_id, [])):
+            provinces = [province_id for province_id in sorted(children.get(region_id, []))
+                         if include is None or province_id in include]
+            line = f"{region_id} {names[region_id]}"
+            if provinces:
+                line += ": " + ", ".join(f"{province_id} {names[province_id]}" for province_id in provinces)
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def build_location_prompt(prompt=None, budget=LOCATION_PROMPT_TOKEN_BUDGET):
+    """
+    Returns the list of locations to send to the LLM, within `budget` tokens.
+
+    Every location is listed when it fits. Otherwise only the provinces matching words of the prompt
+    (and those of the regions or areas it names) are kept, and as a last resort only the candidates.
+
+    Args:
+        prompt (str): The user prompt, used to pre-filter the locations when the full list is too long.
+        budget (int): Maximum number of tokens.
+
+    Returns:
+        str: The encoded locations (see `encode_locations`).
+    """
+    global _full_location_prompt
+    catalog = get_catalog()
+    # The full list and its token count only change with the catalog
+    if _full_location_prompt is None or _full_location_prompt[0] is not catalog:
+        text = encode_locations(catalog=catalog)
+        _full_location_prompt = (catalog, text, count_tokens(text))
+    _, text, tokens = _full_location_prompt
+    if tokens <= budget:
+        return text
+    candidates = location_candidates(prompt) if prompt else []
+    include = set(candidates)
+    for location_id in candidates:
+        for child_id in catalog.location_children.get(location_id, []):
+            include.add(child_id)
+            include.update(catalog.location_children.get(child_id, []))
+    filtered = encode_locations(include, catalog)
+    if count_tokens(filtered) <= budget:
+        return filtered
+    lines = []
+    for location_id in candidates:
+        line = f"{location_id} {catalog.location_names[location_id]}"
+        if count_tokens("\n".join(lines + [line])) > budget:
+            break
+        lines.append(line)
+    return "\n".join(lines)
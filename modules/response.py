@@ -0,0 +1,108 @@
+from types import MappingProxyType
+
+import orjson
+
+from modules.table import *
+
+# Constant fields of every API response (schema/schema.json), around the per-request ones
+RESPONSE_TEMPLATE = MappingProxyType({
+    "title": "Census Data",
+    "description": "A table from census data comparing geography with a population-based statistic.",
+    "type": "object",
+    "requestDuration": 0,
+    "requestTokens": 0,
+    "data": [],
+    "dataURL": "",
+    "dataSource": "Istat",
+    "analysis": ""
+})
+
+
+def _encode_fields(fields):
+    """ Encodes constant fields as the inside of a JSON object ('"key":value,...'), once at import. """
+    return orjson.dumps(dict(fields))[1:-1]
+
+
+_encoded_head = _encode_fields((key, RESPONSE_TEMPLATE[key]) for key in ("title", "description", "type"))
+_encoded_tail = _encode_fields((key, RESPONSE_TEMPLATE[key]) for key in ("dataURL", "dataSource", "analysis"))
+
+
+def _age_variable(age, upper):
+    """
+    Returns the (variableID, variableLabel) of an encoded age or age range in the CL_ETA1 age class group:
+    the SDMX age code, or a range in the syntax of the tool's age argument.
+
+    Example:
+        _age_variable(-1, -1) -> ('TOTAL', 'Total Population'), _age_variable(65, 100) -> ('Y_GE65', 'Age 65-100+')
+    """
+    if age == AGE_TOTAL:
+        return "TOTAL", "Total Population"
+    if age == upper:
+        return ("Y_GE100" if age == AGE_100_PLUS else f"Y{age}"), f"Age {age_label(age)}"
+    variable_id = f"Y_GE{age}" if upper == AGE_100_PLUS else f"Y{age}-{upper}"
+    return variable_id, f"Age {age_label(age)}-{age_label(upper)}"
+
+
+def build_population_data(table):
+    """
+    Builds the `data` rows of the response straight from a `PopulationTable`, one per row.
+
+    Tables merged from several tool calls can hold the same location more than once (e.g. males and females,
+    or two years), so each row also carries its sex (sexID, sexLabel) and timePeriod; its category is the age
+    class (see `_age_variable`).
+
+    Returns:
+        list of dict: Rows in the shape of schema/schema.json.
+    """
+    names = table.location_names
+    upper = table.age if table.age_upper is None else table.age_upper
+    age_variables = {}
+    data = []
+    for location_id, sex, age, age_upper, year, population in zip(
+            table.location_ids().tolist(), table.sex.tolist(), table.age.tolist(), upper.tolist(),
+            table.year.tolist(), table.population.tolist()):
+        age_variable = age_variables.get((age, age_upper))
+        if age_variable is None:
+            age_variable = age_variables[(age, age_upper)] = _age_variable(age, age_upper)
+        data.append({
+            "name": names.get(location_id, "Unknown Location"),
+            "geoID": location_id,
+            "sexID": str(sex),
+            "sexLabel": sex_map.get(str(sex), "Unknown Sex"),
+            "timePeriod": str(year),
+            "groupID": "CL_ETA1",
+            "groupLabel": "Age class",
+            "unit": "individuals",
+            "categories": [
+                {
+                    "variableID": age_variable[0],
+                    "variableLabel": age_variable[1],
+                    "value": population
+                }
+            ]
+        })
+    return data
+
+
+def encode_population_response(data, request_duration=0, request_tokens=0, encoded_data=None):
+    """
+    Serializes a complete API response: the pre-encoded constant fields plus this request's values.
+
+    Args:
+        data (list of dict): The rows built by `build_population_data`.
+        request_duration (float): Milliseconds spent on the request.
+        request_tokens (int): Tokens spent on the request.
+        encoded_data (bytes): `data` already encoded with orjson, to avoid encoding it twice.
+
+    Returns:
+        bytes: The JSON body.
+    """
+    if encoded_data is None:
+        encoded_data = orjson.dumps(data)
+    return b"".join((
+        b"{", _encoded_head,
+        b',"requestDuration":', orjson.dumps(request_duration),
+        b',"requestTokens":', orjson.dumps(request_tokens),
+        b',"data":', encoded_data,
+        b",", _encoded_tail, b"}",
+    ))
@@ -0,0 +1,125 @@
+from modules.catalog import *
+
+
+def _parse_value(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _child_series(series_key, children):
+    """ The series of the locations directly inside the location of `series_key`. """
+    location_id, *rest = series_key
+    return [(child_id, *rest) for child_id in children.get(location_id, ())]
+
+
+def _derivable_series(series_keys, lookup, children):
+    """
+    Cheap necessary check before walking the hierarchy: follows the first child of every series down, one level
+    (one `lookup`) at a time, until a locally known value. A series whose first path ends on a missing
+    location cannot be derived, since a total needs every child; on a cold cache this stops at the first level
+    without a value instead of looking up every descendant.
+    """
+    path_ends = {series_key: series_key for series_key in series_keys}
+    derivable = []
+    while path_ends:
+        next_nodes = {series_key: _child_series(node, children)[0] for series_key, node in path_ends.items()}
+        local_values = lookup(list(dict.fromkeys(next_nodes.values())))
+        path_ends = {}
+        for series_key, node in next_nodes.items():
+            value = local_values.get(node)
+            if value:
+                derivable.append(series_key)
+            elif value is None and children.get(node[0]):
+                path_ends[series_key] = node
+    return derivable
+
+
+def rollup_population_series(series_keys, lookup, catalog=None):
+    """
+    Derives the series of areas, regions and Italy by summing those of the locations directly inside them
+    (see `Catalog.location_children`), themselves found locally or rolled up in turn, so that higher-level
+    totals need no upstream call once the lower levels are cached.
+
+    A total is only derived when every child has a value: a province missing for some year (e.g. before
+    it was established) leaves the series to be fetched. The hierarchy is walked one level at a time, and a
+    location stops being walked as soon as one of its children is known to be missing.
+
+    Args:
+        series_keys (list of tuple): (location_id, sex, age, year) series not found locally.
+        lookup (callable): Returns {series_key: value} for the series it finds locally ('' if known to be absent).
+        catalog (Catalog): Default is the shared catalog.
+
+    Returns:
+        dict: {series_key: value as str} for the series that could be derived.
+    """
+    children = (catalog or get_catalog()).location_children
+    series_keys = [series_key for series_key in series_keys if children.get(series_key[0])]
+    if not series_keys:
+        return {}
+    series_keys = _derivable_series(series_keys, lookup, children)
+    local_values = {}
+    # Series that cannot be derived, and the series whose totals need them
+    failed = set()
+    parents = {}
+
+    def fail(series_key):
+        stack = [series_key]
+        while stack:
+            node = stack.pop()
+            if node not in failed:
+                failed.add(node)
+                stack.extend(parents.get(node, ()))
+
+    level = list(dict.fromkeys(series_keys))
+    visited = set(level)
+    while level:
+        # Locations whose every parent already failed are not worth walking anymore
+        level = [node for node in level
+                 if node not in failed and (node not in parents or any(parent not in failed for parent in parents[node]))]
+        child_keys = []
+        for node in level:
+            for child in _child_series(node, children):
+                parents.setdefault(child, []).append(node)
+                child_keys.append(child)
+        child_keys = list(dict.fromkeys(child_keys))
+        local_values.update(lookup([child for child in child_keys if child not in local_values]))
+        next_level = []
+        for child in child_keys:
+            value = local_values.get(child)
+            if value:
+                continue
+            if value is None and children.get(child[0]):
+                if child not in visited:
+                    visited.add(child)
+                    next_level.append(child)
+            else:
+                fail(child)
+        level = next_level
+
+    derived = {}
+
+    def value_of(series_key):
+        value = local_values.get(series_key)
+        if value:
+            return _parse_value(value)
+        if series_key in failed or not children.get(series_key[0]):
+            return None
+        if series_key not in derived:
+            derived[series_key] = sum_children(series_key)
+        return derived[series_key]
+
+    def sum_children(series_key):
+        total = 0
+        for child in _child_series(series_key, children):
+            value = value_of(child)
+            if value is None:
+                return None
+            total += value
+        return total
+
+    values = {}
+    for series_key in series_keys:
+        total = value_of(series_key)
+        if total is not None:
+            values[series_key] = str(total)
+    return values
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+# Flights by name, e.g. {"sdmx": SingleFlight, "sdmx_async": AsyncSingleFlight}, for `get_single_flight_stats`
+single_flights = {}
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time across threads: callers arriving while a call with the same
+    key is in flight wait for it and receive its result (or its exception) instead of calling again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = {"calls": 0, "shared": 0}
+        self._calls = {}
+        self._lock = threading.Lock()
+        single_flights[name] = self
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Calls `function(*args, **kwargs)`, or waits for the identical call already in flight.
+
+        Args:
+            key (hashable): Identifies identical calls, e.g. the URL.
+            function (callable): The call to make once.
+
+        Returns:
+            The result of the call, shared by every caller: do not modify it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.stats["calls"] += 1
+            else:
+                self.stats["shared"] += 1
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = function(*args, **kwargs)
+            except BaseException as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+
+class AsyncSingleFlight:
+    """
+    Async variant of `SingleFlight`: the first caller starts a task and every identical caller awaits it.
+
+    The task is shielded, so a caller cancelled while waiting (e.g. a client disconnecting) neither cancels
+    the call for the others nor lets it be started again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = {"calls": 0, "shared": 0}
+        self._tasks = {}
+        single_flights[name] = self
+
+    async def do(self, key, function, *args, **kwargs):
+        """
+        Awaits `function(*args, **kwargs)`, or the identical call already in flight.
+
+        Args:
+            key (hashable): Identifies identical calls, e.g. the URL.
+            function (coroutine function): The call to make once.
+
+        Returns:
+            The result of the call, shared by every caller: do not modify it.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+            self.stats["calls"] += 1
+        else:
+            self.stats["shared"] += 1
+        return await asyncio.shield(task)
+
+
+def get_single_flight_stats():
+    """ Returns, per flight, the calls made and the calls that shared an in-flight result instead. """
+    return {name: dict(flight.stats) for name, flight in sorted(single_flights.items())}
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+
+from modules.shared import *
+
+POPULATION_STORE_PATH = config.get("POPULATION_STORE_PATH", DATA_ISTAT_API_PATH + "/population.sqlite")
+
+_local = threading.local()
+
+
+def _connection():
+    """ Returns this thread's connection to the population store, creating the schema on first use. """
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(os.path.dirname(POPULATION_STORE_PATH), exist_ok=True)
+        connection = sqlite3.connect(POPULATION_STORE_PATH)
+        # WAL lets the API keep reading while an ingestion is writing
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS population (
+                dataflow TEXT NOT NULL,
+                location_id TEXT NOT NULL,
+                sex TEXT NOT NULL,
+                age TEXT NOT NULL,
+                year TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (dataflow, location_id, sex, age, year)
+            ) WITHOUT ROWID;
+        """)
+        _local.connection = connection
+    return connection
+
+
+def population_store_available():
+    """ True if a population store has been ingested on this machine. """
+    return os.path.exists(POPULATION_STORE_PATH)
+
+
+def store_population_observations(dataflow, observations, batch_size=10000):
+    """
+    Inserts or replaces (location_id, sex_code, age_code, time_period, obs_value) observations in the store.
+
+    Args:
+        dataflow (str): The dataflow the observations belong to, e.g. '22_289_DF_DCIS_POPRES1_1'.
+        observations (iterable of tuple): Observations as yielded by the SDMX parsers (consumed lazily).
+        batch_size (int): Number of rows written per transaction.
+
+    Returns:
+        int: The number of rows written.
+    """
+    connection = _connection()
+    query = "INSERT OR REPLACE INTO population (dataflow, location_id, sex, age, year, value) VALUES (?, ?, ?, ?, ?, ?)"
+    written = 0
+    batch = []
+    for location_id, sex_code, age_code, time_period, obs_value in observations:
+        batch.append((dataflow, location_id, sex_code, age_code, time_period, int(obs_value)))
+        if len(batch) >= batch_size:
+            with connection:
+                connection.executemany(query, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        with connection:
+            connection.executemany(query, batch)
+        written += len(batch)
+    return written
+
+
+def lookup_population_series(dataflow, series_keys):
+    """
+    Reads (location_id, sex_code, age_code, year) series from the store with one indexed query.
+
+    Returns:
+        dict: {series_key: obs_value as str} for the series present in the store.
+    """
+    if not series_keys or not population_store_available():
+        return {}
+    wanted = set(series_keys)
+    dimensions = [sorted({series_key[i] for series_key in wanted}) for i in range(3)]
+    years = [series_key[3] for series_key in wanted]
+    placeholders = [",".join("?" * len(values)) for values in dimensions]
+    query = (f"SELECT location_id, sex, age, year, value FROM population WHERE dataflow = ? "
+             f"AND location_id IN ({placeholders[0]}) AND sex IN ({placeholders[1]}) AND age IN ({placeholders[2]}) "
+             f"AND year BETWEEN ? AND ?")
+    rows = _connection().execute(query, [dataflow, *dimensions[0], *dimensions[1], *dimensions[2], min(years), max(years)])
+    values = {}
+    for location_id, sex_code, age_code, year, value in rows:
+        series_key = (location_id, sex_code, age_code, year)
+        if series_key in wanted:
+            values[series_key] = str(value)
+    return values
+
+
+def get_population_store_last_year(dataflow):
+    """ Returns the most recent year stored for a dataflow, or None if nothing was ingested. """
+    if not population_store_available():
+        return None
+    row = _connection().execute("SELECT MAX(year) FROM population WHERE dataflow = ?", (dataflow,)).fetchone()
+    return int(row[0]) if row and row[0] is not None else None
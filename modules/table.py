@@ -0,0 +1,243 @@
+import numpy as np
+
+# Map sex codes to descriptive strings
+sex_map = {'1': 'Male', '2': 'Female', '9': 'Total'}
+
+# Encoded ages: 0..99 are exact ages, 100 is "100 and over", TOTAL and unknown codes get negative sentinels
+AGE_TOTAL = -1
+AGE_UNKNOWN = -2
+AGE_100_PLUS = 100
+
+
+def encode_age_code(age_code):
+    """
+    Encodes an SDMX age code as a small integer.
+
+    Example:
+        encode_age_code('Y42') -> 42, encode_age_code('Y_GE100') -> 100, encode_age_code('TOTAL') -> -1
+    """
+    if age_code == 'TOTAL':
+        return AGE_TOTAL
+    if age_code == 'Y_GE100':
+        return AGE_100_PLUS
+    if age_code.startswith('Y') and age_code[1:].isdigit():
+        return int(age_code[1:])
+    return AGE_UNKNOWN
+
+
+def age_label(age):
+    """ Renders an encoded age the way `transform_age_code` does ('total', '100+', '0'...'99'). """
+    if age == AGE_TOTAL:
+        return 'total'
+    if age == AGE_100_PLUS:
+        return '100+'
+    if age == AGE_UNKNOWN:
+        return None
+    return str(age)
+
+
+class PopulationTable:
+    """
+    Columnar population data: one NumPy array per column instead of one dict of strings per row.
+
+    Locations are dictionary-encoded (`location_codes` indexes into `locations`), sex and age are small
+    integers and populations are int64, so the whole table costs a few bytes per row and every
+    group-by/sort runs vectorized. Rows aggregated over an age range keep its upper bound in `age_upper`.
+    `to_rows()` renders the historical list-of-dicts shape for the API.
+    """
+
+    def __init__(self, locations, location_codes, sex, age, year, population, location_names=None, age_upper=None):
+        self.locations = locations
+        self.location_codes = location_codes
+        self.sex = sex
+        self.age = age
+        self.year = year
+        self.population = population
+        self.location_names = location_names if location_names is not None else {}
+        self.age_upper = age_upper
+
+    @classmethod
+    def from_observations(cls, observations, location_names=None):
+        """
+        Builds a table from (location_id, sex_code, age_code, time_period, obs_value) tuples
+        as yielded by the SDMX parsers.
+        """
+        location_index = {}
+        location_codes, sexes, ages, years, values = [], [], [], [], []
+        age_cache = {}
+        for location_id, sex_code, age_code, time_period, obs_value in observations:
+            location_codes.append(location_index.setdefault(location_id, len(location_index)))
+            sexes.append(sex_code)
+            age = age_cache.get(age_code)
+            if age is None:
+                age = age_cache[age_code] = encode_age_code(age_code)
+            ages.append(age)
+            years.append(time_period)
+            values.append(obs_value)
+        return cls(
+            np.array(list(location_index), dtype=object),
+            np.array(location_codes, dtype=np.int32),
+            np.array(sexes, dtype=np.int8),
+            np.array(ages, dtype=np.int16),
+            np.array(years, dtype=np.int16),
+            np.array(values, dtype=np.int64),
+            location_names,
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds a table from rows in the historical list-of-dicts shape (locations are keyed by their names). """
+        sex_codes = {label: code for code, label in sex_map.items()}
+        age_codes = {'total': 'TOTAL', '100+': 'Y_GE100'}
+        observations = (
+            (row['location'], sex_codes.get(row['sex'], '0'), age_codes.get(row['age (years)'], f"Y{row['age (years)']}"),
+             row['time period'], row['population'])
+            for row in rows
+        )
+        return cls.from_observations(observations, {row['location']: row['location'] for row in rows})
+
+    @classmethod
+    def from_columns(cls, columns, location_names=None):
+        """ Builds a table from columns {"location_id", "sex", "age", "time_period", "population"} of SDMX codes and values. """
+        locations, location_codes = np.unique(np.array(columns["location_id"], dtype=object), return_inverse=True)
+        age_codes, age_index = np.unique(np.array(columns["age"], dtype=object), return_inverse=True)
+        encoded_ages = np.array([encode_age_code(age_code) for age_code in age_codes], dtype=np.int16)
+        return cls(
+            locations,
+            location_codes.astype(np.int32),
+            np.array(columns["sex"], dtype=np.int8),
+            encoded_ages[age_index] if len(age_codes) else np.array([], dtype=np.int16),
+            np.array(columns["time_period"], dtype=np.int16),
+            np.array(columns["population"], dtype=np.int64),
+            location_names,
+        )
+
+    @classmethod
+    def concat(cls, tables, location_names=None):
+        """ Concatenates tables, re-encoding their location dictionaries into a shared one. """
+        tables = [table for table in tables if table is not None]
+        if not tables:
+            return cls.from_observations([], location_names)
+        if any(table.age_upper is not None for table in tables):
+            age_upper = np.concatenate([table.age if table.age_upper is None else table.age_upper for table in tables])
+        else:
+            age_upper = None
+        locations = np.unique(np.concatenate([table.locations for table in tables]))
+        location_codes = np.concatenate([
+            np.searchsorted(locations, table.locations)[table.location_codes] if len(table) else table.location_codes
+            for table in tables
+        ]).astype(np.int32)
+        return cls(
+            locations,
+            location_codes,
+            np.concatenate([table.sex for table in tables]),
+            np.concatenate([table.age for table in tables]),
+            np.concatenate([table.year for table in tables]),
+            np.concatenate([table.population for table in tables]),
+            location_names if location_names is not None else tables[0].location_names,
+            age_upper,
+        )
+
+    def __len__(self):
+        return len(self.population)
+
+    def take(self, indices):
+        """ Returns a new table with the rows at `indices` (an index array or boolean mask). """
+        return PopulationTable(self.locations, self.location_codes[indices], self.sex[indices], self.age[indices],
+                               self.year[indices], self.population[indices], self.location_names,
+                               self.age_upper[indices] if self.age_upper is not None else None)
+
+    def location_ids(self):
+        """ Returns the location id of every row as an object array. """
+        return self.locations[self.location_codes]
+
+    def _location_name_array(self):
+        return np.array([self.location_names.get(location_id, "Unknown Location") for location_id in self.locations],
+                        dtype=object)
+
+    def sort(self):
+        """ Sorts by time period, location name and age (TOTAL last), like the historical row output. """
+        if not len(self):
+            return self
+        names = self._location_name_array()
+        name_rank = np.empty(len(names), dtype=np.int32)
+        name_rank[np.argsort(names, kind='stable')] = np.arange(len(names), dtype=np.int32)
+        age_key = np.where(self.age == AGE_TOTAL, 102, np.where(self.age == AGE_100_PLUS, 101, self.age))
+        order = np.lexsort((age_key, name_rank[self.location_codes], self.year))
+        return self.take(order)
+
+    def group_keys(self, by=("location", "sex", "year")):
+        """
+        Returns (group index of every row, row index of the first row of each group) for the given columns.
+        Groups are numbered in order of first appearance.
+        """
+        columns = {"location": self.location_codes, "sex": self.sex, "age": self.age, "year": self.year}
+        combined = np.zeros(len(self), dtype=np.int64)
+        for name in by:
+            column = columns[name].astype(np.int64)
+            _, codes = np.unique(column, return_inverse=True)
+            combined = combined * (codes.max() + 1 if len(codes) else 1) + codes
+        _, first_rows, group_index = np.unique(combined, return_index=True, return_inverse=True)
+        # Renumber groups by first appearance so that results keep the table order
+        appearance = np.argsort(first_rows, kind='stable')
+        renumber = np.empty_like(appearance)
+        renumber[appearance] = np.arange(len(appearance))
+        return renumber[group_index.ravel()], first_rows[appearance]
+
+    def group_sum(self, by=("location", "sex", "year")):
+        """
+        Sums populations over every column not in `by`, in one vectorized pass.
+
+        When age is summed over, each group keeps the youngest age in `age` and the oldest in `age_upper`,
+        so that it renders as a range such as '85-100+'.
+
+        Returns:
+            PopulationTable: One row per group, in order of first appearance.
+        """
+        if not len(self):
+            return self
+        group_index, first_rows = self.group_keys(by)
+        groups = len(first_rows)
+        grouped = self.take(first_rows)
+        grouped.population = np.bincount(group_index, weights=self.population, minlength=groups).astype(np.int64)
+        if "age" not in by:
+            upper = self.age if self.age_upper is None else self.age_upper
+            grouped.age = np.full(groups, np.iinfo(np.int16).max, dtype=np.int16)
+            grouped.age_upper = np.full(groups, np.iinfo(np.int16).min, dtype=np.int16)
+            np.minimum.at(grouped.age, group_index, self.age)
+            np.maximum.at(grouped.age_upper, group_index, upper)
+        return grouped
+
+    def has_multiple_ages(self):
+        """ True if some (location, sex, year) combination has more than one row. """
+        if not len(self):
+            return False
+        group_index, first_rows = self.group_keys(("location", "sex", "year"))
+        return len(first_rows) < len(self)
+
+    def to_rows(self, age_labels=None):
+        """
+        Renders the table in the historical list-of-dicts shape (all values as strings).
+
+        Args:
+            age_labels (list of str): Optional label per row replacing the rendered age (e.g. aggregated ranges).
+        """
+        names = self._location_name_array()[self.location_codes].tolist()
+        sexes = [sex_map.get(str(sex), "Unknown Sex") for sex in self.sex.tolist()]
+        if age_labels is not None:
+            ages = age_labels
+        elif self.age_upper is not None:
+            ages = [age_label(age) if age == upper else f"{age_label(age)}-{age_label(upper)}"
+                    for age, upper in zip(self.age.tolist(), self.age_upper.tolist())]
+        else:
+            ages = [age_label(age) for age in self.age.tolist()]
+        return [
+            {
+                'location': name,
+                'sex': sex,
+                'age (years)': age,
+                'time period': str(year),
+                'population': str(population)
+            }
+            for name, sex, age, year, population in zip(names, sexes, ages, self.year.tolist(), self.population.tolist())
+        ]
@@ -0,0 +1,231 @@
+import re
+import json
+import asyncio
+
+from modules.utils import *
+
+# Accepted values of the tool arguments, beyond the JSON schema types
+tool_argument_patterns = {
+    "location_ids": re.compile(r'^[A-Z0-9]+(\+[A-Z0-9]+)*$'),
+    "sex": re.compile(r'^[129](\+[129])*$'),
+    # A single age range code, or exact ages combined with '+' (see `combine_ages`)
+    "age": re.compile(r'^(TOTAL|Y_GE\d{1,3}|Y_UN\d{1,3}|Y\d{1,3}-\d{1,3}|Y\d{1,3}(\+Y\d{1,3})*)$'),
+    "start_period": re.compile(r'^\d{4}(-\d{2}-\d{2})?$'),
+    "end_period": re.compile(r'^\d{4}(-\d{2}-\d{2})?$'),
+}
+
+# Single-year age codes of the population dataflow, which every age argument must expand to
+population_age_codes = {f"Y{age}" for age in range(100)} | {"Y_GE100"}
+
+tool_registry = {}
+
+
+class ToolArgumentError(ValueError):
+    """ Raised when the arguments chosen by the LLM for a tool are not valid. """
+
+
+def register_tool(definition, function):
+    """
+    Registers an async implementation under the name of its OpenAI tool definition.
+
+    Args:
+        definition (dict): An entry of `tools` ({"type": "function", "function": {"name", "parameters", ...}}).
+        function (coroutine function): The implementation, called with the validated arguments.
+    """
+    schema = definition["function"]
+    tool_registry[schema["name"]] = {
+        "function": function,
+        "definition": definition,
+        "properties": schema["parameters"].get("properties", {}),
+        "required": set(schema["parameters"].get("required", [])),
+    }
+
+
+def build_tool_registry(definitions=tools, functions=async_tool_functions):
+    """ Registers every tool of `definitions` that has an implementation in `functions`. """
+    for definition in definitions:
+        name = definition["function"]["name"]
+        if name in functions:
+            register_tool(definition, functions[name])
+    return tool_registry
+
+
+def _with_location_choices(definition, location_choices):
+    """ Copy of a tool definition whose location_ids description lists the valid ids. """
+    properties = definition["function"]["parameters"]["properties"]
+    if "location_ids" not in properties:
+        return definition
+    location_ids = dict(properties["location_ids"])
+    location_ids["description"] += f". Valid identifiers (id name):\n{location_choices}"
+    parameters = {**definition["function"]["parameters"], "properties": {**properties, "location_ids": location_ids}}
+    return {**definition, "function": {**definition["function"], "parameters": parameters}}
+
+
+def get_tool_definitions(location_choices=None):
+    """
+    Returns the definitions of the registered tools, to pass as `tools` to a chat completion.
+
+    Args:
+        location_choices (str): Optional list of the valid location ids (see `build_location_prompt`), added to the location_ids description so
+            that the model can choose them in the same turn as the tool call.
+    """
+    definitions = [entry["definition"] for entry in tool_registry.values()]
+    if location_choices:
+        definitions = [_with_location_choices(definition, location_choices) for definition in definitions]
+    return definitions
+
+
+def _normalize_argument(name, value):
+    value = "+".join(part.strip() for part in value.strip().split("+"))
+    if name in ("location_ids", "sex", "age"):
+        value = value.upper()
+    if name == "start_period" and len(value) == 4:
+        value += "-01-01"
+    if name == "end_period" and len(value) == 4:
+        value += "-12-31"
+    return value
+
+
+def _selects_valid_ages(age):
+    """
+    True if an age argument expands (see `combine_ages`) to at least one age, all of them existing codes.
+    'Y_UN0' or 'Y5-3' expand to nothing, which would leave the age dimension empty, i.e. every age.
+    """
+    if age == "TOTAL":
+        return True
+    if age.startswith("Y_GE") and int(age[4:]) > 100:
+        return False
+    codes = combine_ages(age).split("+")
+    return all(code in population_age_codes for code in codes)
+
+
+def validate_tool_arguments(name, arguments):
+    """
+    Checks the arguments of a tool call against the tool schema and `tool_argument_patterns`.
+
+    Args:
+        name (str): The tool name chosen by the LLM.
+        arguments (str or dict): The arguments, as the JSON string of the tool call or already decoded.
+
+    Returns:
+        dict: The normalized arguments (unknown arguments dropped, years expanded to dates).
+
+    Raises:
+        ToolArgumentError: If the tool is unknown or an argument is missing or invalid.
+    """
+    entry = tool_registry.get(name)
+    if entry is None:
+        raise ToolArgumentError(f"Unknown tool: {name}")
+    if isinstance(arguments, str):
+        try:
+            arguments = json.loads(arguments or "{}")
+        except json.JSONDecodeError as e:
+            raise ToolArgumentError(f"Arguments of {name} are not valid JSON: {e}")
+    if not isinstance(arguments, dict):
+        raise ToolArgumentError(f"Arguments of {name} must be an object")
+    missing = entry["required"] - arguments.keys()
+    if missing:
+        raise ToolArgumentError(f"Missing arguments for {name}: {', '.join(sorted(missing))}")
+    validated = {}
+    for key, value in arguments.items():
+        if key not in entry["properties"]:
+            continue
+        if entry["properties"][key].get("type") == "string":
+            if not isinstance(value, (str, int)):
+                raise ToolArgumentError(f"Argument {key} of {name} must be a string")
+            value = _normalize_argument(key, str(value))
+            pattern = tool_argument_patterns.get(key)
+            if pattern is not None and not pattern.match(value):
+                raise ToolArgumentError(f"Invalid value for {key}: {value!r}")
+            if key == "age" and not _selects_valid_ages(value):
+                raise ToolArgumentError(f"Invalid value for {key}: {value!r} selects no age")
+        validated[key] = value
+    if validated.get("start_period", "") > validated.get("end_period", "9999"):
+        raise ToolArgumentError(f"start_period {validated['start_period']} is after end_period {validated['end_period']}")
+    return validated
+
+
+def validate_tool_calls(tool_calls):
+    """
+    Validates every tool call of a completion (see `validate_tool_arguments`).
+
+    Returns:
+        list: One (tool call, arguments) tuple per call, in order. Arguments is None if the call was invalid.
+    """
+    calls = []
+    for tool_call in tool_calls or []:
+        try:
+            arguments = validate_tool_arguments(tool_call.function.name, tool_call.function.arguments)
+        except ToolArgumentError as e:
+            print(f"Invalid tool call: {e}")
+            arguments = None
+        calls.append((tool_call, arguments))
+    return calls
+
+
+async def run_tool_calls(tool_calls):
+    """
+    Validates and runs every tool call of a completion concurrently; identical calls run once.
+
+    Args:
+        tool_calls (list): The `tool_calls` of a chat completion message.
+
+    Returns:
+        list: One (tool call, arguments, result) tuple per call, in order. Result is None if the call was
+              invalid or failed.
+    """
+    calls = validate_tool_calls(tool_calls)
+    unique = {}
+    for tool_call, arguments in calls:
+        if arguments is not None:
+            key = (tool_call.function.name, json.dumps(arguments, sort_keys=True))
+            unique.setdefault(key, (tool_call.function.name, arguments))
+    results = await asyncio.gather(
+        *(tool_registry[name]["function"](**arguments) for name, arguments in unique.values()),
+        return_exceptions=True,
+    )
+    results_by_key = {}
+    for key, result in zip(unique, results):
+        if isinstance(result, Exception):
+            print(f"An error occurred while running {key[0]}: {result}")
+            result = None
+        results_by_key[key] = result
+    return [
+        (tool_call, arguments,
+         results_by_key[(tool_call.function.name, json.dumps(arguments, sort_keys=True))] if arguments is not None else None)
+        for tool_call, arguments in calls
+    ]
+
+
+def merge_tool_results(results):
+    """
+    Merges the tables returned by several tool calls into one.
+
+    Each table is aggregated over its own age range first (see `group_population_by_age`), so that a
+    call for "over 65" and a call for "TOTAL" are never summed together.
+
+    Returns:
+        PopulationTable: The merged and sorted table, or None if no call returned data.
+    """
+    tables = []
+    seen = set()
+    for _, _, table in results:
+        # Identical calls share one result, merged once
+        if table is None or not len(table) or id(table) in seen:
+            continue
+        seen.add(id(table))
+        if has_multiple_ages(table):
+            with timed_stage("aggregation"):
+                table = group_population_by_age(table)
+        tables.append(table)
+    if not tables:
+        return None
+    if len(tables) == 1:
+        return tables[0]
+    location_names = {}
+    for table in tables:
+        location_names.update(table.location_names)
+    return PopulationTable.concat(tables, location_names).sort()
+
+
+build_tool_registry()
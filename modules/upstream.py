@@ -0,0 +1,250 @@
+import time
+import random
+import asyncio
+import weakref
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from modules.shared import *
+
+# Connection pool, timeouts, retries and circuit breaker of the ISTAT SDMX client, overridable from .env
+SDMX_CLIENT_SETTINGS = {
+    "max_connections": int(config.get("SDMX_MAX_CONNECTIONS", 20)),
+    "connect_timeout": float(config.get("SDMX_CONNECT_TIMEOUT", 5)),
+    "read_timeout": float(config.get("SDMX_READ_TIMEOUT", 30)),
+    "max_retries": int(config.get("SDMX_MAX_RETRIES", 3)),
+    # Retry n waits about backoff_factor * 2 ** (n - 1) seconds plus up to `backoff_jitter`, at most `backoff_max`
+    "backoff_factor": float(config.get("SDMX_BACKOFF_FACTOR", 0.5)),
+    "backoff_jitter": float(config.get("SDMX_BACKOFF_JITTER", 0.5)),
+    "backoff_max": float(config.get("SDMX_BACKOFF_MAX", 10)),
+    # Consecutive failed requests that open the circuit, and seconds before a trial request is let through
+    "breaker_failure_threshold": int(config.get("SDMX_BREAKER_FAILURE_THRESHOLD", 5)),
+    "breaker_reset_timeout": float(config.get("SDMX_BREAKER_RESET_TIMEOUT", 30)),
+}
+
+# Statuses worth retrying: rate limiting and transient server errors
+SDMX_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+sdmx_default_headers = {"Accept-Encoding": "gzip, deflate"}
+
+_sdmx_session = None
+_sdmx_session_lock = threading.Lock()
+# One async client per event loop: httpx connections cannot be shared between loops
+_sdmx_async_clients = weakref.WeakKeyDictionary()
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of sending a request while the circuit breaker is open. """
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing. After `failure_threshold` consecutive failures the circuit
+    opens and requests fail immediately; after `reset_timeout` seconds one trial request is let through,
+    closing the circuit again if it succeeds.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_request(self):
+        """
+        Raises CircuitOpenError unless the request may be sent.
+
+        Returns:
+            bool: True if the request is the trial of a half-open circuit, which the caller must `release_trial`
+            however the request ends.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        raise CircuitOpenError(f"Circuit '{self.name}' is open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """ Lets another trial through if the current one ended without recording a result (e.g. cancelled). """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self):
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+sdmx_breaker = CircuitBreaker("sdmx", SDMX_CLIENT_SETTINGS["breaker_failure_threshold"],
+                              SDMX_CLIENT_SETTINGS["breaker_reset_timeout"])
+
+
+def _is_upstream_failure(status_code):
+    return status_code in SDMX_RETRY_STATUSES
+
+
+def get_sdmx_session():
+    """
+    Returns the shared `requests` session for ISTAT: keep-alive pool, gzip/deflate, and jittered retries
+    on connection errors, 429 and 5xx (honouring Retry-After).
+    """
+    global _sdmx_session
+    if _sdmx_session is None:
+        with _sdmx_session_lock:
+            if _sdmx_session is None:
+                settings = SDMX_CLIENT_SETTINGS
+                retry = Retry(
+                    total=settings["max_retries"],
+                    backoff_factor=settings["backoff_factor"],
+                    backoff_jitter=settings["backoff_jitter"],
+                    backoff_max=settings["backoff_max"],
+                    status_forcelist=SDMX_RETRY_STATUSES,
+                    allowed_methods=["GET"],
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings["max_connections"], max_retries=retry)
+                session = requests.Session()
+                session.headers.update(sdmx_default_headers)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sdmx_session = session
+    return _sdmx_session
+
+
+def sdmx_get(url, headers=None, stream=False):
+    """
+    Sends a GET request to ISTAT through the shared session, the circuit breaker and the configured timeouts.
+
+    Returns:
+        requests.Response: The response (its status is not checked, except for counting failures).
+
+    Raises:
+        CircuitOpenError: If the circuit is open.
+        requests.RequestException: If the request still fails after the retries.
+    """
+    trial = sdmx_breaker.before_request()
+    settings = SDMX_CLIENT_SETTINGS
+    try:
+        response = get_sdmx_session().get(url, headers=headers, stream=stream,
+                                          timeout=(settings["connect_timeout"], settings["read_timeout"]))
+    except Exception:
+        # Unexpected errors count too, otherwise a failing trial would hold the circuit half-open
+        sdmx_breaker.record_failure()
+        raise
+    finally:
+        if trial:
+            sdmx_breaker.release_trial()
+    if _is_upstream_failure(response.status_code):
+        sdmx_breaker.record_failure()
+    else:
+        sdmx_breaker.record_success()
+    return response
+
+
+def _retry_delay(attempt, retry_after=None):
+    """ Seconds to wait before retry `attempt` (1-based), as `Retry` computes them for the sync session. """
+    settings = SDMX_CLIENT_SETTINGS
+    if retry_after is not None and retry_after.isdigit():
+        return min(float(retry_after), settings["backoff_max"])
+    delay = settings["backoff_factor"] * 2 ** (attempt - 1) + random.uniform(0, settings["backoff_jitter"])
+    return min(delay, settings["backoff_max"])
+
+
+def get_sdmx_async_client():
+    """ Returns the shared `httpx.AsyncClient` for ISTAT of the running event loop. """
+    loop = asyncio.get_running_loop()
+    client = _sdmx_async_clients.get(loop)
+    if client is None or client.is_closed:
+        settings = SDMX_CLIENT_SETTINGS
+        client = httpx.AsyncClient(
+            headers=sdmx_default_headers,
+            limits=httpx.Limits(max_connections=settings["max_connections"]),
+            timeout=httpx.Timeout(settings["read_timeout"], connect=settings["connect_timeout"]),
+        )
+        _sdmx_async_clients[loop] = client
+    return client
+
+
+async def sdmx_stream_async(url, headers=None):
+    """
+    Async variant of `sdmx_get` with stream=True: retries connection errors, timeouts, 429 and 5xx with the same
+    jittered backoff before any byte of the body is read.
+
+    Returns:
+        httpx.Response: The open streamed response; the caller reads it and must `aclose()` it.
+
+    Raises:
+        CircuitOpenError: If the circuit is open.
+        httpx.HTTPError: If the request still fails after the retries.
+    """
+    trial = sdmx_breaker.before_request()
+    client = get_sdmx_async_client()
+    attempts = SDMX_CLIENT_SETTINGS["max_retries"] + 1
+    try:
+        for attempt in range(1, attempts + 1):
+            try:
+                response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+            except httpx.TransportError:
+                if attempt == attempts:
+                    raise
+                await asyncio.sleep(_retry_delay(attempt))
+                continue
+            if not _is_upstream_failure(response.status_code):
+                sdmx_breaker.record_success()
+                return response
+            await response.aclose()
+            if attempt == attempts:
+                sdmx_breaker.record_failure()
+                return response
+            await asyncio.sleep(_retry_delay(attempt, response.headers.get("Retry-After")))
+    except Exception:
+        # Unexpected errors count too; a cancelled trial is only released below
+        sdmx_breaker.record_failure()
+        raise
+    finally:
+        if trial:
+            sdmx_breaker.release_trial()
+
+
+async def close_sdmx_clients():
+    """ Closes the pooled ISTAT clients (called on application shutdown). """
+    global _sdmx_session
+    for client in list(_sdmx_async_clients.values()):
+        await client.aclose()
+    _sdmx_async_clients.clear()
+    if _sdmx_session is not None:
+        _sdmx_session.close()
+        _sdmx_session = None
+
+
+def get_sdmx_client_stats():
+    """ Returns the state of the ISTAT circuit breaker. """
+    return {"breaker": sdmx_breaker.snapshot()}
@@ -1,14 +1,52 @@
 import requests
+import httpx
+import asyncio
 import re
 import os
+import csv
+import codecs
 import glob
 from xml.etree import ElementTree as ET
 import json
+import contextvars
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from modules.shared import *
+from modules.cache import *
+from modules.table import *
+from modules.aggregation import *
+from modules.store import *
+from modules.municipalities import *
+from modules.catalog import *
+from modules.metrics import *
+from modules.singleflight import *
+from modules.upstream import *
+from modules.planner import *
+from modules.rollup import *
 
 useful_dataflow_ids = ['22_289']
+population_dataflow = '22_289_DF_DCIS_POPRES1_1'
+# Representation requested for data queries: "csv" (SDMX-CSV, falls back to XML if refused) or "xml" (generic data)
+SDMX_DATA_FORMAT = config.get("SDMX_DATA_FORMAT", "csv")
+sdmx_media_types = {
+    "csv": "application/vnd.sdmx.data+csv;version=1.0.0",
+    "xml": "application/vnd.sdmx.genericdata+xml;version=2.1",
+}
+# Identical SDMX requests in flight at the same time are sent once (see `SingleFlight`)
+sdmx_flight = SingleFlight("sdmx")
+sdmx_flight_async = AsyncSingleFlight("sdmx_async")
+# Concurrent requests used by the metadata refresh pipeline
+METADATA_MAX_WORKERS = int(config.get("METADATA_MAX_WORKERS", 8))
+# Namespaces of the SDMX structure messages
+structure_ns = {
+    'mes': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
+    'str': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
+    'structure': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
+    'com': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
+    'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
+    'xml': 'http://www.w3.org/XML/1998/namespace'
+}
 
 #################################################
 ####### json and jsonl functions  ###############
@@ -91,15 +129,8 @@ def read_jsonl_file(file_name, type='str'):
 
 
 def assemble_locations():
-    file_names = ['_geographic_areas', '_regions', '_provinces']
-    locations = []  # Initialize the list to store results
-    for name in file_names:
-        file_path = DATA_ISTAT_API_PATH + "/ITTER107/" + name + ".jsonl"
-        with open(file_path, 'r', encoding='utf-8') as file:  # Ensure proper handling of the file opening
-            for line in file:
-                data = json.loads(line)
-                locations.append(data)
-    return locations
+    """ Returns the geographic areas, regions and provinces as single-key {name: id} dictionaries (read once per process). """
+    return list(get_catalog().locations)
 
 
 
@@ -151,6 +182,7 @@ def get_location_type_files(location_type, first_letter=None):
     Args:
         location_type (str): The type of location for which the data is to be retrieved.
                              Valid values are '_geographic_areas', '_regions', '_provinces', and '_municipalities'.
+        first_letter (str): For municipalities, the initial of the shard to read. Default is None for all municipalities.
 
     Returns:
         list: A list of dictionaries representing the contents of the JSONL file. If the location type is not recognized,
@@ -163,7 +195,10 @@ def get_location_type_files(location_type, first_letter=None):
     elif location_type == '_provinces':
         location_type_file = read_jsonl_file("ITTER107/_provinces.jsonl")
     elif location_type == '_municipalities':
-        location_type_file = read_jsonl_file(f"ITTER107/_municipalities{first_letter}.jsonl")
+        if first_letter:
+            location_type_file = read_jsonl_file(f"ITTER107/_municipalities_{first_letter.upper()}.jsonl")
+        else:
+            location_type_file = read_jsonl_file("ITTER107/_municipalities.jsonl")
     return location_type_file
 
 
@@ -204,11 +239,8 @@ def clean_location_id(input_string):
 
 
 def get_version_by_dataflow_id(dataflow_id):
-    data = read_jsonl_file("useful_istat_datasets.jsonl", "list")
-    for entry in data:
-        if entry["dataflow_id"] == dataflow_id:
-            return entry["version"]
-    return None
+    entry = get_catalog().datasets.get(dataflow_id)
+    return entry["version"] if entry else None
 
 
 def transform_age_code(age_code):
@@ -229,6 +261,9 @@ def query_api(url):
     """
         Sends a GET request to the specified URL and returns the response content as a string.
 
+        Concurrent calls for the same URL share one request (see `SingleFlight`), sent through the pooled
+        session with timeouts, retries and the circuit breaker (see `sdmx_get`).
+
         The function attempts to fetch the content from the provided URL using a GET request.
         It handles HTTP errors and returns the content of the response if successful.
         The response encoding is explicitly set to 'utf-8'.
@@ -244,16 +279,88 @@ def query_api(url):
             requests.RequestException: If there is an issue with the request, such as a network problem or
                                        a non-2xx HTTP status code, an error message is printed.
         """
+    return sdmx_flight.do(url, _query_api, url)
+
+
+def _query_api(url):
     try:
-        response = requests.get(url)
+        response = sdmx_get(url)
         response.raise_for_status()  # Raises an HTTPError for bad responses
         response.encoding = 'utf-8'
         return response.text
-    except requests.RequestException as e:
+    except (requests.RequestException, CircuitOpenError) as e:
         print(f"An error occurred: {e}")
         return None
 
 
+async def query_api_async(url):
+    """
+    Async variant of `query_api`: sends the GET request without blocking the event loop.
+    Concurrent calls for the same URL share one request.
+
+    Args:
+        url (str): The URL to which the GET request is sent.
+
+    Returns:
+        str: The content of the response as a string if the request is successful.
+        None: If an error occurs during the request, the function returns None and prints an error message.
+    """
+    return await sdmx_flight_async.do(url, _query_api_async, url)
+
+
+async def _query_api_async(url):
+    try:
+        response = await sdmx_stream_async(url)
+        try:
+            response.raise_for_status()
+            await response.aread()
+        finally:
+            await response.aclose()
+        response.encoding = 'utf-8'
+        return response.text
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        print(f"An error occurred: {e}")
+        return None
+
+
+def query_api_stream(url, headers=None, chunk_size=64 * 1024):
+    """
+    Streams the body of a GET request in chunks instead of loading it in memory as a whole.
+
+    Args:
+        url (str): The URL to which the GET request is sent.
+        headers (dict): Optional request headers, e.g. an Accept header for content negotiation.
+        chunk_size (int): Size in bytes of the yielded chunks (after gzip/deflate decoding).
+
+    Yields:
+        bytes: Successive chunks of the response body.
+
+    Raises:
+        requests.RequestException: If the request fails or returns a non-2xx HTTP status code.
+        CircuitOpenError: If ISTAT kept failing and the circuit breaker is open.
+    """
+    with sdmx_get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size=chunk_size)
+
+
+async def query_api_stream_async(url, headers=None, chunk_size=64 * 1024):
+    """
+    Async variant of `query_api_stream`.
+
+    Raises:
+        httpx.HTTPError: If the request fails or returns a non-2xx HTTP status code.
+        CircuitOpenError: If ISTAT kept failing and the circuit breaker is open.
+    """
+    response = await sdmx_stream_async(url, headers=headers)
+    try:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+    finally:
+        await response.aclose()
+
+
 def _parse_dataflows(xml_data):
     try:
         root = ET.fromstring(xml_data)
@@ -293,16 +400,44 @@ def _filter_and_save_dataflows(dataflows, filter_ids, file_name):
     save_as_jsonl(filtered_dataflows, file_name)
 
 
-def _fetch_codelist_name(ref_id):
+def _fetch_codelist_root(ref_id):
+    """ Fetches and parses a codelist, returning its XML root element or None if it could not be retrieved. """
     url = f"https://esploradati.istat.it/SDMXWS/rest/codelist/IT1/{ref_id}"
     xml_data = query_api(url)
     if xml_data:
-        root = ET.fromstring(xml_data)
-        name_element = root.find('.//com:Name[@xml:lang="en"]', {
-            'com': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
-            'xml': 'http://www.w3.org/XML/1998/namespace'
-        })
-        return name_element.text if name_element is not None else "Name not found"
+        try:
+            return ET.fromstring(xml_data)
+        except ET.ParseError as e:
+            print(f"Error parsing XML for codelist {ref_id}: {e}")
+    return None
+
+
+def _codelist_name(root):
+    name_element = root.find('.//com:Name[@xml:lang="en"]', structure_ns)
+    return name_element.text if name_element is not None else "Name not found"
+
+
+def _fetch_codelist_name(ref_id):
+    root = _fetch_codelist_root(ref_id)
+    if root is not None:
+        return _codelist_name(root)
+
+
+def _fetch_codelists(ref_ids, max_workers=METADATA_MAX_WORKERS):
+    """ Fetches and parses each distinct codelist once, with at most `max_workers` concurrent requests. """
+    ref_ids = list(dict.fromkeys(ref_ids))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(ref_ids, executor.map(_fetch_codelist_root, ref_ids)))
+
+
+def _parse_datastructure_dimensions(xml_data):
+    """ Returns the (dimension id, codelist id) pairs declared by a datastructure message. """
+    root = ET.fromstring(xml_data)
+    pairs = []
+    for dimension in root.findall('.//str:DataStructureComponents/str:DimensionList/str:Dimension', structure_ns):
+        for ref in dimension.findall('.//str:Enumeration/Ref', structure_ns):
+            pairs.append((dimension.get('id'), ref.get('id')))
+    return pairs
 
 
 
@@ -336,6 +471,7 @@ def fetch_parse_and_save_dataflows():
         if dataflows:
             save_as_jsonl(dataflows, "all_istat_datasets.jsonl")
             _filter_and_save_dataflows(dataflows, useful_dataflow_ids, "useful_istat_datasets.jsonl")
+            reset_catalog()
 
 
 def fetch_parse_and_save_datastructure(structure_ref):
@@ -363,26 +499,20 @@ def fetch_parse_and_save_datastructure(structure_ref):
     url = f"https://esploradati.istat.it/SDMXWS/rest/datastructure/IT1/{structure_ref}"
     xml_data = query_api(url)
     if xml_data:
-        root = ET.fromstring(xml_data)
-        ns = {
-            'mes': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
-            'str': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
-            'com': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common'
-        }
+        pairs = _parse_datastructure_dimensions(xml_data)
+        # The codelist names are fetched concurrently, each codelist once
+        ref_ids = list(dict.fromkeys(ref_id for _, ref_id in pairs))
+        with ThreadPoolExecutor(max_workers=METADATA_MAX_WORKERS) as executor:
+            names = dict(zip(ref_ids, executor.map(_fetch_codelist_name, ref_ids)))
         results = []
-        dimensions = root.findall('.//str:DataStructureComponents/str:DimensionList/str:Dimension', ns)
-        for dimension in dimensions:
-            dim_id = dimension.get('id')
-            enumeration_refs = dimension.findall('.//str:Enumeration/Ref', ns)
-            for ref in enumeration_refs:
-                ref_id = ref.get('id')
-                name_en = _fetch_codelist_name(ref_id)
-                if name_en:
-                    results.append({
-                        'dimension': dim_id,
-                        'dimension_id': ref_id,
-                        'description': name_en
-                    })
+        for dim_id, ref_id in pairs:
+            name_en = names[ref_id]
+            if name_en:
+                results.append({
+                    'dimension': dim_id,
+                    'dimension_id': ref_id,
+                    'description': name_en
+                })
         return results
 
 
@@ -390,9 +520,7 @@ def get_dataset_info_by_dataflow_id(dataflow_id_value):
     """
     Retrieves dataset information from a JSON Lines (JSONL) file based on the specified dataflow ID.
 
-    The function reads through a JSONL file containing dataset information, searching for an entry that
-    matches the given `dataflow_id_value`. When a match is found, it returns the corresponding dataset
-    information as a dictionary.
+    The file is read once per process through the catalog, and looked up by dataflow ID.
 
     Args:
         dataflow_id_value (str): The ID of the dataflow for which information is to be retrieved.
@@ -400,20 +528,8 @@ def get_dataset_info_by_dataflow_id(dataflow_id_value):
     Returns:
         dict: A dictionary containing the dataset information for the specified dataflow ID.
               If no matching dataflow ID is found, an empty dictionary is returned.
-
-    Raises:
-        IOError: If there is an issue reading the JSONL file, an error will be raised by the `open` function.
     """
-    result = {}
-    file_path = DATA_ISTAT_API_PATH + '/useful_istat_datasets.jsonl'
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            row = json.loads(line)
-            if row['dataflow_id'] == dataflow_id_value:
-                result = row
-                break
-    return result
-
+    return dict(get_catalog().datasets.get(dataflow_id_value, {}))
 
 
 def get_datastructures(dataflow_id):
@@ -493,6 +609,105 @@ def get_constraints_list_from_dimension(file_path, target_dimension_id):
     return None
 
 
+# Pattern and output file of each CL_ITTER107 extraction type, checked in this order by `classify_CL_ITTER107_code`
+CL_ITTER107_levels = {
+    # IT Italy
+    "A": (re.compile(r'^(ITC|ITD|ITE|ITF|ITG)$|^IT$'), "_geographic_areas.jsonl"),
+    # include ITDA Trentino Alto Adige
+    # exclude ITD1 Provincia Autonoma di Bolzano, ITD2 Provincia Autonoma di Trento
+    "R": (re.compile(r'^(ITC|ITE|ITF|ITG)\d$|^(ITD)(?!1$|2$)\d$|^ITDA$'), "_regions.jsonl"),
+    # include IT111 Sud Sardegna, IT108 Monza e Brianza, IT110 Barletta-Andria-Trani, IT109 Fermo, ITC4A Cremona, ITE1A Grosseto, ITC4B Mantova
+    # exclude ITG29 Olbia-Tempio
+    "P": (re.compile(r"^(ITC|ITD|ITE|ITF)(\d{2})$|^(ITG)(?!29$)\d{2}$|^IT111$|^IT108$|^IT110$|^IT109$|^ITC4A$|^ITE1A$|^ITC4B$"), "_provinces.jsonl"),
+    "M": (re.compile(r'^\d{6}$'), "_municipalities.jsonl"),
+}
+
+# Shorter Italian names used instead of the bilingual ones of the codelist
+CL_ITTER107_name_overrides = {
+    ("ITC2", "Valle d'Aosta / Vallée d'Aoste"): "Valle d'Aosta",
+    ("ITC20", "Valle d'Aosta / Vallée d'Aoste"): "Aosta",
+    ("ITD10", "Bolzano / Bozen"): "Bolzano",
+    ("ITDA", "Trentino Alto Adige / Südtirol"): "Trentino Alto Adige",
+}
+
+_code_tag = f"{{{structure_ns['structure']}}}Code"
+_name_tag = f"{{{structure_ns['common']}}}Name"
+_lang_attribute = f"{{{structure_ns['xml']}}}lang"
+
+
+def classify_CL_ITTER107_code(code_id):
+    """
+    Returns the extraction type of a CL_ITTER107 code ("A", "R", "P" or "M"), or None for codes of no level
+    (e.g. historical provinces).
+
+    Example:
+        classify_CL_ITTER107_code("ITD55") -> "P", classify_CL_ITTER107_code("ITD1") -> None
+    """
+    for extraction_type, (pattern, _) in CL_ITTER107_levels.items():
+        if pattern.match(code_id):
+            return extraction_type
+    return None
+
+
+def _save_jsonl_records(records, file_path):
+    """ Writes single-key {name: id} records sorted by name, one JSON object per line. """
+    with open(file_path, 'w', encoding='utf-8') as file:
+        for record in sorted(records, key=lambda x: next(iter(x)) or ''):
+            json_record = json.dumps(record, ensure_ascii=False)
+            file.write(json_record + '\n')
+
+
+def _save_CL_ITTER107_levels(root, CL_ITTER107_constraints, extraction_types):
+    """
+    Writes the location files of several extraction types from an already parsed CL_ITTER107 codelist.
+    See `save_CL_ITTER107_codelist_as_jsonl` for the extraction types.
+
+    The codelist is walked once: each constrained code is classified with `classify_CL_ITTER107_code` and
+    appended to the records of its level, municipalities also to the shard of their first letter.
+    """
+    for extraction_type in extraction_types:
+        if extraction_type not in CL_ITTER107_levels:
+            print("Invalid extraction type provided.")
+            return
+    if CL_ITTER107_constraints is None:
+        print("No CL_ITTER107 constraints found: run get_constraints first.")
+        return
+    constraints = set(CL_ITTER107_constraints)
+    results = {extraction_type: [] for extraction_type in extraction_types}
+    municipalities_by_letter = defaultdict(list)
+    for code in root.iter(_code_tag):
+        code_id = code.get('id')
+        if code_id not in constraints:
+            continue
+        extraction_type = classify_CL_ITTER107_code(code_id)
+        if extraction_type not in results:
+            continue
+        italian_name = None
+        for name_element in code.iter(_name_tag):
+            if name_element.get(_lang_attribute) == 'it':
+                italian_name = name_element.text
+                break
+        italian_name = CL_ITTER107_name_overrides.get((code_id, italian_name), italian_name)
+        result = {italian_name: code_id}
+        results[extraction_type].append(result)
+        # Municipalities are also grouped by first letter
+        if extraction_type == "M" and italian_name:
+            municipalities_by_letter[italian_name[0].upper()].append(result)
+    try:
+        for extraction_type, records in results.items():
+            file_name = CL_ITTER107_levels[extraction_type][1]
+            _save_jsonl_records(records, f"{DATA_ISTAT_API_PATH}/ITTER107/{file_name}")
+            print(f"Data successfully saved to {file_name}")
+        for letter, municipalities in municipalities_by_letter.items():
+            _save_jsonl_records(municipalities, f"{DATA_ISTAT_API_PATH}/ITTER107/_municipalities_{letter}.jsonl")
+            print(f"Data successfully saved to _municipalities_{letter}.jsonl")
+        if "M" in results:
+            build_municipality_index(results["M"])
+        reset_catalog()
+    except IOError as e:
+        print(f"An error occurred while writing the JSONL file: {e}")
+
+
 def save_CL_ITTER107_codelist_as_jsonl(extraction_type, dataflow_id):
     """
     Queries an API to fetch XML data for a specific data flow ID and processes this data based on the
@@ -504,6 +719,7 @@ def save_CL_ITTER107_codelist_as_jsonl(extraction_type, dataflow_id):
     Args:
         extraction_type (str): The type of extraction to perform, which affects the regex pattern used for filtering:
                                "A" for geographic areas, "M" for municipalities, "R" for regions, and "P" for provinces.
+                               Several types can be combined, e.g. "ARPM", to write them all from one download.
         dataflow_id (str): Identifier for the data flow from which to fetch and process XML data.
 
     Returns:
@@ -513,87 +729,28 @@ def save_CL_ITTER107_codelist_as_jsonl(extraction_type, dataflow_id):
         IOError: If there is an issue writing the JSONL file.
         xml.etree.ElementTree.ParseError: If there are issues parsing the XML data.
     """
-    url = "https://esploradati.istat.it/SDMXWS/rest/codelist/IT1/CL_ITTER107"
-    xml_data = query_api(url)
+    root = _fetch_codelist_root("CL_ITTER107")
     CL_ITTER107_constraints = get_constraints_list_from_dimension(f"{DATA_ISTAT_API_PATH}/{dataflow_id}__constraints.jsonl", "CL_ITTER107")
-    if xml_data:
-        try:
-            root = ET.fromstring(xml_data)
-            ns = {
-                'structure': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
-                'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
-                'xml': 'http://www.w3.org/XML/1998/namespace'
-            }
-            results = []
-            municipalities_by_letter = {}
-            # Define the pattern and file name based on extraction type
-            if extraction_type == "A":
-                pattern = r'^(ITC|ITD|ITE|ITF|ITG)$|^IT$'  # IT Italy
-                file_name = "_geographic_areas.jsonl"
-            elif extraction_type == "R":
-                # include ITDA Trentino Alto Adige
-                # exclude ITD1 Provincia Autonoma di Bolzano, ITD2 Provincia Autonoma di Trento
-                pattern = r'^(ITC|ITE|ITF|ITG)\d$|^(ITD)(?!1$|2$)\d$|^ITDA$'
-                file_name = "_regions.jsonl"
-            elif extraction_type == "P":
-                # include IT111 Sud Sardegna, IT108 Monza e Brianza, IT110 Barletta-Andria-Trani, IT109 Fermo, ITC4A Cremona, ITE1A Grosseto, ITC4B Mantova
-                # exclude ITG29 Olbia-Tempio
-                pattern = r"^(ITC|ITD|ITE|ITF)(\d{2})$|^(ITG)(?!29$)\d{2}$|^IT111$|^IT108$|^IT110$|^IT109$|^ITC4A$|^ITE1A$|^ITC4B$"
-                file_name = "_provinces.jsonl"
-            elif extraction_type == "M":
-                pattern = r'^\d{6}$'
-                file_name = "_municipalities.jsonl"
-            else:
-                print("Invalid extraction type provided.")
-                return
-            # Find all 'structure:Code' elements in the XML
-            for code in root.findall('.//structure:Code', ns):
-                code_id = code.get('id')
-                if code_id in CL_ITTER107_constraints:
-                    # Check if the 'structure:Code id' matches the pattern
-                    if re.match(pattern, code_id):
-                        italian_name_element = code.find('common:Name[@xml:lang="it"]', ns)
-                        italian_name = italian_name_element.text if italian_name_element is not None else None
-                        if code_id == "ITC2" and italian_name == "Valle d'Aosta / Vallée d'Aoste":
-                            italian_name = "Valle d'Aosta"
-                        if code_id == "ITC20" and italian_name == "Valle d'Aosta / Vallée d'Aoste":
-                            italian_name = "Aosta"
-                        if code_id == "ITD10" and italian_name == "Bolzano / Bozen":
-                            italian_name = "Bolzano"
-                        if code_id == "ITDA" and italian_name == "Trentino Alto Adige / Südtirol":
-                            italian_name = "Trentino Alto Adige"
-                        result = {
-                            italian_name: code_id
-                        }
-                        results.append(result)
-                        # If municipalities, group by the first letter
-                        if extraction_type == "M" and italian_name:
-                            first_letter = italian_name[0].upper()
-                            if first_letter not in municipalities_by_letter:
-                                municipalities_by_letter[first_letter] = []
-                            municipalities_by_letter[first_letter].append(result)
-            # Sort the results by 'italian_name' key before saving
-            results_sorted = sorted(results, key=lambda x: list(x.keys())[0], reverse=False)
-            # Save the general JSONL file
-            file_path = f"{DATA_ISTAT_API_PATH}/ITTER107/{file_name}"
-            with open(file_path, 'w', encoding='utf-8') as file:
-                for result in results_sorted:
-                    json_record = json.dumps(result, ensure_ascii=False)
-                    file.write(json_record + '\n')
-            print(f"Data successfully saved to {file_name}")
-            # Save individual files for each letter if municipalities were selected
-            if extraction_type == "M":
-                for letter, municipalities in municipalities_by_letter.items():
-                    letter_file_path = f"{DATA_ISTAT_API_PATH}/ITTER107/_municipalities_{letter}.jsonl"
-                    with open(letter_file_path, 'w', encoding='utf-8') as letter_file:
-                        for municipality in sorted(municipalities, key=lambda x: list(x.keys())[0], reverse=False):
-                            json_record = json.dumps(municipality, ensure_ascii=False)
-                            letter_file.write(json_record + '\n')
-                    print(f"Data successfully saved to _municipalities_{letter}.jsonl")
-        except ET.ParseError as e:
-            print(f"XML parsing error: {e}")
-        except IOError as e:
-            print(f"An error occurred while writing the JSONL file: {e}")
+    if root is not None:
+        _save_CL_ITTER107_levels(root, CL_ITTER107_constraints, extraction_type)
+
+
+def _save_codelist_jsonl(root, dataflow_id, dimension_id, dim_constraints):
+    """ Writes the {English name: id} file of an already parsed codelist, keeping the codes constrained by the data flow. """
+    results = []
+    file_name = f"{dataflow_id}_{dimension_id}__codelist.jsonl"
+    # Find all 'structure:Code' elements in the XML
+    for code in root.findall('.//structure:Code', structure_ns):
+        code_id = code.get('id')
+        if code_id in dim_constraints:
+            element = code.find('common:Name[@xml:lang="en"]', structure_ns)
+            el_name = element.text if element is not None else None
+            results.append({el_name: code_id})
+    try:
+        _save_jsonl_records(results, f"{DATA_ISTAT_API_PATH}/{file_name}")
+        print(f"Data successfully saved to {file_name}")
+    except IOError as e:
+        print(f"An error occurred while writing the JSONL file: {e}")
 
 
 def save_codelist_as_jsonl(dataflow_id, dimension_id):
@@ -615,41 +772,10 @@ def save_codelist_as_jsonl(dataflow_id, dimension_id):
         IOError: If there is an issue writing to the JSONL file.
         xml.etree.ElementTree.ParseError: If there are issues parsing the XML data.
     """
-    url = f"https://esploradati.istat.it/SDMXWS/rest/codelist/IT1/{dimension_id}"
-    xml_data = query_api(url)
+    root = _fetch_codelist_root(dimension_id)
     dim_constraints = get_constraints_list_from_dimension(f"{DATA_ISTAT_API_PATH}/{dataflow_id}__constraints.jsonl", dimension_id)
-    if xml_data:
-        try:
-            root = ET.fromstring(xml_data)
-            ns = {
-                'structure': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
-                'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
-                'xml': 'http://www.w3.org/XML/1998/namespace'
-            }
-            results = []
-            file_name = f"{dataflow_id}_{dimension_id}__codelist.jsonl"
-            # Find all 'structure:Code' elements in the XML
-            for code in root.findall('.//structure:Code', ns):
-                code_id = code.get('id')
-                if code_id in dim_constraints:
-                    element = code.find('common:Name[@xml:lang="en"]', ns)
-                    el_name = element.text if element is not None else None
-                    result = {
-                        el_name: code_id
-                    }
-                    results.append(result)
-            results_sorted = sorted(results, key=lambda x: list(x.keys())[0], reverse=False)
-            # Save the general JSONL file
-            file_path = f"{DATA_ISTAT_API_PATH}/{file_name}"
-            with open(file_path, 'w', encoding='utf-8') as file:
-                for result in results_sorted:
-                    json_record = json.dumps(result, ensure_ascii=False)
-                    file.write(json_record + '\n')
-            print(f"Data successfully saved to {file_name}")
-        except ET.ParseError as e:
-            print(f"XML parsing error: {e}")
-        except IOError as e:
-            print(f"An error occurred while writing the JSONL file: {e}")
+    if root is not None:
+        _save_codelist_jsonl(root, dataflow_id, dimension_id, dim_constraints)
 
 
 def _fetch_dimension_xml(dimension_id):
@@ -697,6 +823,25 @@ def _get_datastructure_xml_files(dataflow_id: str, datastructures: list):
             print(f"An error occurred while writing the XML file: {e}")
 
 
+def _build_datastructures(pairs, codelists):
+    """ Builds the datastructure records of `fetch_parse_and_save_datastructure` from already parsed codelists. """
+    return [{'dimension': dim_id, 'dimension_id': ref_id, 'description': _codelist_name(codelists[ref_id])}
+            for dim_id, ref_id in pairs if codelists.get(ref_id) is not None]
+
+
+def _add_constraints(datastructures, codelists):
+    """ Stores the codes of each dimension's codelist under 'constraints', as saved in the constraints file. """
+    for dim in datastructures:
+        root = codelists.get(dim['dimension_id'])
+        if root is not None:
+            # Extract and store constraints
+            codes = root.findall('.//structure:Code', structure_ns)
+            constraints = [code.get('id') for code in codes if code.get('id') is not None]
+            if constraints:
+                dim['constraints'] = constraints
+    return datastructures
+
+
 def get_constraints(dataflow_id):
     """
     Fetches and saves constraints along with dimension metadata for a given dataflow ID.
@@ -709,35 +854,70 @@ def get_constraints(dataflow_id):
     """
     # Fetch dimension metadata
     selected_dataset_info = get_dataset_info_by_dataflow_id(dataflow_id)
-    datastructures = fetch_parse_and_save_datastructure(selected_dataset_info['datastructure_id'])
-    # Define namespaces
-    ns = {
-        'message': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
-        'structure': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
-        'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common'
-    }
-    # Fetch constraints and parse them
-    # skip_id = "CL_ITTER107"
-    for dim in datastructures:
-        # if dim['dimension_id'] == skip_id:
-            # continue
-        constraints_url = f"https://esploradati.istat.it/SDMXWS/rest/codelist/IT1/{dim['dimension_id']}"
-        constraints_xml_data = query_api(constraints_url)
-        if constraints_xml_data:
-            # Parse the XML string into an ElementTree object
-            try:
-                root = ET.fromstring(constraints_xml_data)
-                # Extract and store constraints
-                codes = root.findall('.//structure:Code', ns)
-                constraints = [code.get('id') for code in codes if code.get('id') is not None]
-                if constraints:
-                    dim['constraints'] = constraints
-            except ET.ParseError as e:
-                print(f"Error parsing XML for dimension {dim['dimension_id']}: {e}")
+    url = f"https://esploradati.istat.it/SDMXWS/rest/datastructure/IT1/{selected_dataset_info['datastructure_id']}"
+    xml_data = query_api(url)
+    if not xml_data:
+        return
+    pairs = _parse_datastructure_dimensions(xml_data)
+    # Each codelist is fetched once and used for both the dimension description and its constraints
+    codelists = _fetch_codelists(ref_id for _, ref_id in pairs)
+    datastructures = _add_constraints(_build_datastructures(pairs, codelists), codelists)
     # Save the datastructures with constraints as JSONL
     save_as_jsonl(datastructures, f"{dataflow_id}__constraints.jsonl")
 
 
+def refresh_metadata_catalog(dataflow_ids=None, max_workers=METADATA_MAX_WORKERS):
+    """
+    Rebuilds every metadata file in one pass: dataflow lists, datastructures, constraints, codelists
+    and the ITTER107 location files.
+
+    Each datastructure and codelist is downloaded and parsed at most once, with at most `max_workers`
+    concurrent requests, and all derived JSONL files are written from those parsed documents.
+
+    Args:
+        dataflow_ids (list): The data flows to refresh. Default is `useful_dataflow_ids`.
+        max_workers (int): Maximum number of concurrent requests.
+
+    Returns:
+        None: Prints a message for every file saved.
+    """
+    dataflow_ids = dataflow_ids or useful_dataflow_ids
+    fetch_parse_and_save_dataflows()
+    dataset_infos = {dataflow_id: get_dataset_info_by_dataflow_id(dataflow_id) for dataflow_id in dataflow_ids}
+    dataset_infos = {dataflow_id: info for dataflow_id, info in dataset_infos.items() if info}
+    structure_refs = list(dict.fromkeys(info['datastructure_id'] for info in dataset_infos.values()))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        structure_urls = [f"https://esploradati.istat.it/SDMXWS/rest/datastructure/IT1/{ref}" for ref in structure_refs]
+        structures = {}
+        for ref, xml_data in zip(structure_refs, executor.map(query_api, structure_urls)):
+            try:
+                structures[ref] = _parse_datastructure_dimensions(xml_data) if xml_data else []
+            except ET.ParseError as e:
+                print(f"Error parsing XML for datastructure {ref}: {e}")
+                structures[ref] = []
+    codelists = _fetch_codelists((ref_id for pairs in structures.values() for _, ref_id in pairs), max_workers)
+    all_datastructures = []
+    locations_saved = False
+    for dataflow_id, info in dataset_infos.items():
+        datastructures = _build_datastructures(structures[info['datastructure_id']], codelists)
+        save_as_jsonl(datastructures, f"{info['dataflow_id']}__datastructures.jsonl")
+        all_datastructures.extend(datastructures)
+        datastructures = _add_constraints([dict(dim) for dim in datastructures], codelists)
+        save_as_jsonl(datastructures, f"{dataflow_id}__constraints.jsonl")
+        for dim in datastructures:
+            constraints = set(dim.get('constraints', ()))
+            if codelists.get(dim['dimension_id']) is None:
+                continue
+            if dim['dimension_id'] == "CL_ITTER107":
+                # The location files do not depend on the data flow: written once
+                if not locations_saved:
+                    _save_CL_ITTER107_levels(codelists["CL_ITTER107"], constraints, "ARPM")
+                    locations_saved = True
+            else:
+                _save_codelist_jsonl(codelists[dim['dimension_id']], dataflow_id, dim['dimension_id'], constraints)
+    save_as_jsonl(list({dim['dimension_id']: dim for dim in all_datastructures}.values()), "useful_datastructures.jsonl")
+
+
 ######################################################
 ############## LLM TOOLS and FUNCTIONS ###############
 ######################################################
@@ -753,7 +933,7 @@ tools=[
           "properties": {
             "location_ids": {
               "type": "string",
-              "description": "Geographical identifiers for the locations, concatenated by '+' if multiple, e.g., 'ITC+ITE2+ITF14'"
+              "description": "Geographical identifiers for the locations, concatenated by '+' if multiple, e.g., 'ITC+ITE2+ITF14'. Municipalities have 6-digit identifiers, e.g., '040007'"
             },
             "sex": {
               "type": "string",
@@ -785,13 +965,12 @@ def group_population_by_age(data):
     then summarize the ages into an interval and sum the population.
 
     Args:
-        data (list of dict): A list of dictionaries where each dictionary contains
-            information about location, sex, age, time period, and population.
+        data (PopulationTable or list of dict): The population data, either as a table or as a list of
+            dictionaries where each dictionary contains information about location, sex, age, time period, and population.
 
     Returns:
-        list of dict: A list of dictionaries where the entries have been grouped by
-                      location, sex, and time period, with ages aggregated into a range,
-                      and populations summed.
+        PopulationTable or list of dict: Entries grouped by location, sex, and time period, with ages
+                      aggregated into a range, and populations summed (a table if a table was given).
 
     Example:
         data = [
@@ -802,40 +981,22 @@ def group_population_by_age(data):
         result = aggregate_ages(data)
         # Returns [{'location': 'Bologna', 'sex': 'Total', 'age (years)': '85-100+', 'time period': '2023', 'population': 'sum of all populations'}]
     """
-    grouped_data = defaultdict(list)
-    # Group data by location, sex, and time period
-    for entry in data:
-        key = (entry['location'], entry['sex'], entry['time period'])
-        grouped_data[key].append(entry)
-    result = []
-    # Aggregate data for each group
-    for (location, sex, time_period), entries in grouped_data.items():
-        min_age = float('inf')
-        max_age = float('-inf')
-        total_population = 0
-        for entry in entries:
-            # Determine the minimum and maximum ages
-            age = entry['age (years)']
-            if age == '100+':
-                max_age = '100+'
-            else:
-                age = int(age)
-                min_age = min(min_age, age)
-                if max_age != '100+':  # Ensure '100+' remains the maximum
-                    max_age = max(max_age, age)
-            # Sum the population
-            total_population += int(entry['population'])
-        # Define age range as 'min_age-max_age'
-        age_range = f"{min_age}-{max_age}" if max_age == '100+' or min_age != max_age else f"{min_age}"
-        # Append the aggregated result
-        result.append({
-            'location': location,
-            'sex': sex,
-            'age (years)': age_range,
-            'time period': time_period,
-            'population': str(total_population)
-        })
-    return result
+    if isinstance(data, PopulationTable):
+        return _sum_age_range(data)
+    # Rows are encoded once and summed in a single vectorized pass, see `aggregate_age_bands`
+    return _sum_age_range(PopulationTable.from_rows(data)).to_rows()
+
+
+def _sum_age_range(table):
+    """
+    Sums every single-year age of the table into one band, from its youngest to its oldest age: the range
+    requested by a tool call, also for groups missing some of its ages.
+    """
+    ages = table.age[table.age >= 0]
+    if not len(ages):
+        return table.group_sum(("location", "sex", "year"))
+    upper = ages if table.age_upper is None else table.age_upper[table.age >= 0]
+    return aggregate_age_bands(table, [(int(ages.min()), int(upper.max()))])["table"]
 
 
 def has_multiple_ages(data):
@@ -843,13 +1004,15 @@ def has_multiple_ages(data):
     Check if there are multiple entries for the same combination of location, sex, and time period.
 
     Args:
-        data (list of dict): A list of dictionaries where each dictionary contains
-            information about location, sex, age, time period, and population.
+        data (PopulationTable or list of dict): The population data, either as a table or as a list of
+            dictionaries where each dictionary contains information about location, sex, age, time period, and population.
 
     Returns:
         bool: True if there are multiple entries for the same combination of
               location, sex, and time period, otherwise False.
     """
+    if isinstance(data, PopulationTable):
+        return data.has_multiple_ages()
     count_data = defaultdict(int)
     # Count occurrences for each location, sex, and time period combination
     for entry in data:
@@ -927,50 +1090,416 @@ def age_str_to_int(age_str):
     return int(age_str)  # Convert numeric age strings to integers
 
 
+class SDMXGenericDataParser:
+    """
+    Incremental parser for SDMX generic data messages.
+
+    Chunks of the response are fed as they arrive and the observations of every completed Series are
+    returned right away as (location_id, sex_code, age_code, time_period, obs_value) tuples. Each Series
+    is cleared once decoded, so memory stays flat however large the response is.
+    """
+    _generic_ns = '{http://www.sdmx.org/resources/sdmxml/schemas/v2_1/data/generic}'
+    _series_tag = _generic_ns + 'Series'
+    _series_key_tag = _generic_ns + 'SeriesKey'
+    _obs_tag = _generic_ns + 'Obs'
+    _obs_dimension_tag = _generic_ns + 'ObsDimension'
+    _obs_value_tag = _generic_ns + 'ObsValue'
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('end',))
+
+    def feed(self, chunk):
+        self._parser.feed(chunk)
+        return self._read_events()
+
+    def close(self):
+        self._parser.close()
+        return self._read_events()
+
+    def _read_events(self):
+        observations = []
+        for _, element in self._parser.read_events():
+            if element.tag != self._series_tag:
+                continue
+            series_key = {value.get('id'): value.get('value') for value in element.find(self._series_key_tag)}
+            location_id, sex_code, age_code = series_key.get('REF_AREA'), series_key.get('SEX'), series_key.get('AGE')
+            for obs in element.iterfind(self._obs_tag):
+                time_period = obs.find(self._obs_dimension_tag).get('value')
+                obs_value = obs.find(self._obs_value_tag).get('value')
+                observations.append((location_id, sex_code, age_code, time_period, obs_value))
+            element.clear()
+        return observations
+
+
+class SDMXCSVParser:
+    """
+    Incremental parser for SDMX-CSV data messages, with the same interface as `SDMXGenericDataParser`.
+
+    Columns are located by name from the header line, so the order of the dimensions does not matter.
+    Raises ValueError if the header is not SDMX-CSV (e.g. the server ignored the Accept header).
+    """
+    _columns = ('REF_AREA', 'SEX', 'AGE', 'TIME_PERIOD', 'OBS_VALUE')
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._buffer = ''
+        self._indexes = None
+
+    def feed(self, chunk):
+        self._buffer += self._decoder.decode(chunk)
+        complete, newline, self._buffer = self._buffer.rpartition('\n')
+        return self._read_lines(complete) if newline else []
+
+    def close(self):
+        lines = self._buffer + self._decoder.decode(b'', final=True)
+        self._buffer = ''
+        return self._read_lines(lines)
+
+    def _read_lines(self, text):
+        rows = csv.reader(line.rstrip('\r') for line in text.split('\n') if line.strip())
+        if self._indexes is None:
+            header = next(rows, None)
+            if header is None:
+                return []
+            if any(column not in header for column in self._columns):
+                raise ValueError(f"Response is not SDMX-CSV (starts with {','.join(header)[:80]!r})")
+            self._indexes = [header.index(column) for column in self._columns]
+        location, sex, age, time_period, obs_value = self._indexes
+        return [(row[location], row[sex], row[age], row[time_period], row[obs_value]) for row in rows if row[obs_value]]
+
+
+def iter_population_observations_from_chunks(chunks, parser=None):
+    """
+    Decodes an SDMX data message given as an iterable of byte chunks, yielding
+    (location_id, sex_code, age_code, time_period, obs_value) tuples as soon as they are parsed.
+
+    Args:
+        chunks (iterable of bytes): The message body.
+        parser: `SDMXGenericDataParser` (default) or `SDMXCSVParser`.
+    """
+    if parser is None:
+        parser = SDMXGenericDataParser()
+    for chunk in chunks:
+        with timed_stage("sdmx_parse"):
+            observations = parser.feed(chunk)
+        yield from observations
+    with timed_stage("sdmx_parse"):
+        observations = parser.close()
+    yield from observations
+
+
+def _iter_population_observations(xml_content):
+    """
+    Yields one (location_id, sex_code, age_code, time_period, obs_value) tuple per observation
+    of an SDMX generic data message given as a string.
+    """
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode('utf-8')
+    chunk_size = 64 * 1024
+    chunks = (xml_content[i:i + chunk_size] for i in range(0, len(xml_content), chunk_size))
+    return iter_population_observations_from_chunks(chunks)
+
+
+def _is_format_refused(status_code):
+    """ Statuses with which the endpoint rejects the requested representation (rather than the query). """
+    return status_code in (406, 415, 501)
+
+
+def _stream_population_observations(url):
+    """
+    Fetches and decodes a data query, preferring the compact SDMX-CSV representation and
+    falling back to generic XML when the endpoint refuses CSV or answers with something else.
+    """
+    if SDMX_DATA_FORMAT == "csv":
+        try:
+            chunks = query_api_stream(url, headers={"Accept": sdmx_media_types["csv"]})
+            # The header line is validated before any observation is yielded, so the fallback never duplicates rows
+            yield from iter_population_observations_from_chunks(chunks, SDMXCSVParser())
+            return
+        except requests.HTTPError as e:
+            if not _is_format_refused(e.response.status_code):
+                raise
+            print(f"SDMX-CSV refused ({e.response.status_code}), falling back to XML")
+        except ValueError as e:
+            print(f"{e}, falling back to XML")
+    chunks = query_api_stream(url, headers={"Accept": sdmx_media_types["xml"]})
+    yield from iter_population_observations_from_chunks(chunks, SDMXGenericDataParser())
+
+
+async def _fetch_population_observations_async(url):
+    """ Async variant of `_stream_population_observations`, returning the decoded observations as a list. """
+    formats = ["csv", "xml"] if SDMX_DATA_FORMAT == "csv" else ["xml"]
+    for data_format in formats:
+        parser = SDMXCSVParser() if data_format == "csv" else SDMXGenericDataParser()
+        observations = []
+        try:
+            async for chunk in query_api_stream_async(url, headers={"Accept": sdmx_media_types[data_format]}):
+                with timed_stage("sdmx_parse"):
+                    observations.extend(parser.feed(chunk))
+            with timed_stage("sdmx_parse"):
+                observations.extend(parser.close())
+            return observations
+        except httpx.HTTPStatusError as e:
+            if data_format == "xml" or not _is_format_refused(e.response.status_code):
+                raise
+            print(f"SDMX-CSV refused ({e.response.status_code}), falling back to XML")
+        except ValueError as e:
+            if data_format == "xml":
+                raise
+            print(f"{e}, falling back to XML")
+
+
 def extract_and_format_data_from_xml_for_streamlit_app(xml_content):
-    # Parse the XML content
-    root = ET.fromstring(xml_content)
-    # Define namespaces for the XML structure
-    ns = {
-        'generic': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/data/generic',
-        'message': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
-        'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common'
-    }
-    # Create a dictionary from the locations list for faster lookup
-    location_dict = {item[next(iter(item))]: next(iter(item)) for item in locations}
-    # List to store the data from all series
-    extracted_data = []
-    # Iterate over each series in the DataSet
-    for series in root.findall('.//generic:Series', ns):
-        # Extract common series information
-        ref_area_code = series.find(".//generic:Value[@id='REF_AREA']", ns).get('value')
-        # Get the location name using the location dictionary
-        ref_area_name = location_dict.get(ref_area_code,
-                                          "Unknown Location")  # Default to "Unknown Location" if not found
-        age_code = series.find(".//generic:Value[@id='AGE']", ns).get('value')
-        age_description = transform_age_code(age_code)
-        sex_code = series.find(".//generic:Value[@id='SEX']", ns).get('value')
-        # Map sex codes to descriptive strings
-        sex_map = {'1': 'Male', '2': 'Female', '9': 'Total'}
-        sex_description = sex_map.get(sex_code, "Unknown Sex")  # Default to "Unknown Sex" if not found
-        # Iterate over each observation in the series
-        for obs in series.findall('.//generic:Obs', ns):
-            time_period = obs.find(".//generic:ObsDimension[@id='TIME_PERIOD']", ns).get('value')
-            obs_value = obs.find('.//generic:ObsValue', ns).get('value')
-            # Append extracted data to the series data list
-            extracted_data.append({
-                'location': ref_area_name,
-                'sex': sex_description,
-                'age (years)': age_description,
-                'time period': time_period,
-                'population': obs_value
-            })
-    # Sorting the list of dictionaries by 'time period', 'location', and 'age (years)'
-    extracted_data_sorted = sorted(
-        extracted_data,
-        key=lambda x: (int(x['time period']), x['location'], age_str_to_int(x['age (years)']))
-    )
-    return extracted_data_sorted
+    table = PopulationTable.from_observations(_iter_population_observations(xml_content))
+    table.location_names = get_location_names(table.locations.tolist())
+    return table.sort().to_rows()
+
+
+def _expand_population_series(location_ids, sex, age, start_period, end_period):
+    """
+    Expands the query parameters into the individual (location, sex, age, year) series they cover,
+    in request order and without duplicates.
+    """
+    combined_age = age.upper() if age.upper() == "TOTAL" else combine_ages(age)
+    location_list = list(dict.fromkeys(code.strip() for code in location_ids.split('+')))
+    sex_list = list(dict.fromkeys(code.strip() for code in sex.split('+')))
+    age_list = list(dict.fromkeys(code.strip() for code in combined_age.split('+')))
+    years = [str(year) for year in range(int(start_period[:4]), int(end_period[:4]) + 1)]
+    return [(location_id, sex_code, age_code, year)
+            for location_id in location_list for sex_code in sex_list for age_code in age_list for year in years]
+
+
+def _lookup_local_series(series_keys):
+    """ Returns the values found in the cache, then in the population store ('' for series known to be absent). """
+    cached = get_cached_sdmx_many([(population_dataflow, *series_key) for series_key in series_keys])
+    values = {}
+    missing = []
+    for series_key in series_keys:
+        value = cached.get((population_dataflow, *series_key))
+        if value is None:
+            missing.append(series_key)
+        else:
+            values[series_key] = value
+    if missing:
+        values.update(lookup_population_series(population_dataflow, missing))
+    return values
+
+
+def _split_cached_series(series_keys):
+    """
+    Returns the values found locally ('' for series known to be absent upstream) and the keys still to fetch.
+    The cache is checked first, then the bulk-loaded population store, then areas, regions and Italy are
+    summed from the locations inside them (see `rollup_population_series`).
+    """
+    values = _lookup_local_series(series_keys)
+    missing = [series_key for series_key in series_keys if series_key not in values]
+    if missing:
+        values.update(rollup_population_series(missing, _lookup_local_series))
+        missing = [series_key for series_key in missing if series_key not in values]
+    return values, missing
+
+
+def _store_fetched_series(missing, observations):
+    """
+    Caches every fetched observation (the combined URL may return more series than were missing)
+    and remembers the missing series that ISTAT did not return, so they are not requested again.
+    """
+    values = {}
+    for location_id, sex_code, age_code, time_period, obs_value in observations:
+        values[(location_id, sex_code, age_code, time_period)] = obs_value
+    absent = [series_key for series_key in missing if series_key not in values]
+    # One transaction per time to live instead of one write per series
+    set_cached_sdmx_many([((population_dataflow, *series_key), value) for series_key, value in values.items()])
+    set_cached_sdmx_many([((population_dataflow, *series_key), '') for series_key in absent], SDMX_NEGATIVE_CACHE_TTL)
+    for series_key in absent:
+        values[series_key] = ''
+    return values
+
+
+def _fetch_missing_series(url, missing):
+    """
+    Downloads a planned data query and caches its series (see `_store_fetched_series`).
+    ISTAT answers 404 when the query matches no data: every series of the chunk is then cached as absent.
+    """
+    try:
+        return _store_fetched_series(missing, _stream_population_observations(url))
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+    return _store_fetched_series(missing, [])
+
+
+async def _fetch_missing_series_async(url, missing):
+    with timed_stage("sdmx_fetch"):
+        try:
+            observations = await _fetch_population_observations_async(url)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            observations = []
+    with timed_stage("cache_write"):
+        return await asyncio.to_thread(_store_fetched_series, missing, observations)
+
+
+def _shared_series_values(missing, fetched):
+    """
+    Picks the values of the series a caller was missing from a fetch that may have been shared with other
+    requests for the same URL: a wildcarded query returns every series of its dimensions, so the leader's
+    values hold more than any one caller asked for. Series ISTAT did not return are absent ('').
+    """
+    return {series_key: fetched.get(series_key, '') for series_key in missing}
+
+
+def _stale_series_values(missing):
+    """
+    Returns expired cached values for every missing series, or None if any of them is not on disk anymore.
+    Used when ISTAT cannot be reached: a slightly old figure is better than no answer.
+    """
+    values = {}
+    for series_key in missing:
+        value = get_stale_sdmx((population_dataflow, *series_key))
+        if value is None:
+            return None
+        values[series_key] = value
+    return values
+
+
+def _fetch_planned_series(plan):
+    """
+    Runs one planned query; concurrent requests for the same URL wait for this download instead of sending
+    their own. A chunk without data (404) is not a failure, see `_fetch_missing_series`.
+    Falls back to stale cached values if ISTAT fails.
+
+    Returns:
+        dict: The values of the series of the plan, or None if they could not be fetched.
+    """
+    url, missing = plan["url"], plan["series"]
+    print(url)
+    try:
+        # Observations are decoded and cached while the response is still downloading
+        return _shared_series_values(missing, sdmx_flight.do(("series", url), _fetch_missing_series, url, missing))
+    except (requests.RequestException, CircuitOpenError) as e:
+        print(f"An error occurred: {e}")
+    stale = _stale_series_values(missing)
+    if stale is not None:
+        print("Serving stale cached values")
+    return stale
+
+
+async def _fetch_planned_series_async(plan, semaphore):
+    """ Async variant of `_fetch_planned_series`, running at most as many queries at a time as `semaphore` allows. """
+    url, missing = plan["url"], plan["series"]
+    print(url)
+    try:
+        async with semaphore:
+            fetched = await sdmx_flight_async.do(("series", url), _fetch_missing_series_async, url, missing)
+        return _shared_series_values(missing, fetched)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        print(f"An error occurred: {e}")
+    stale = await asyncio.to_thread(_stale_series_values, missing)
+    if stale is not None:
+        print("Serving stale cached values")
+    return stale
+
+
+def _fetch_series(missing):
+    """
+    Fetches the missing series with the queries planned by `plan_population_queries`, several at a time.
+
+    Returns:
+        dict: The values of every missing series, or None if any query failed.
+    """
+    plans = plan_population_queries(missing, population_dataflow)
+    if len(plans) == 1:
+        results = [_fetch_planned_series(plans[0])]
+    else:
+        # Each worker runs in a copy of the request context, so its stages are added to the request metrics
+        with ThreadPoolExecutor(max_workers=min(SDMX_MAX_PARALLEL_QUERIES, len(plans))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, _fetch_planned_series, plan) for plan in plans]
+            results = [future.result() for future in futures]
+    if any(result is None for result in results):
+        return None
+    return {series_key: value for result in results for series_key, value in result.items()}
+
+
+async def _fetch_series_async(missing):
+    """ Async variant of `_fetch_series`: the planned queries run concurrently on the event loop. """
+    plans = plan_population_queries(missing, population_dataflow)
+    semaphore = asyncio.Semaphore(SDMX_MAX_PARALLEL_QUERIES)
+    results = await asyncio.gather(*(_fetch_planned_series_async(plan, semaphore) for plan in plans))
+    if any(result is None for result in results):
+        return None
+    return {series_key: value for result in results for series_key, value in result.items()}
+
+
+def get_location_names(location_ids):
+    """
+    Returns {id: name} for the given ids: areas, regions and provinces from the catalog,
+    municipalities from the municipality index.
+    """
+    location_names = get_catalog().location_names
+    names = {}
+    for location_id in location_ids:
+        name = location_names.get(location_id) or get_municipality_name(location_id)
+        if name:
+            names[location_id] = name
+    return names
+
+
+def _population_table_from_series(series_keys, values):
+    """ Builds the sorted table of the series that have a value; codes are encoded once per column. """
+    present = [series_key for series_key in series_keys if values.get(series_key)]
+    location_ids, sexes, ages, years = zip(*present) if present else ((),) * 4
+    table = PopulationTable.from_columns({
+        "location_id": location_ids,
+        "sex": sexes,
+        "age": ages,
+        "time_period": years,
+        "population": [values[series_key] for series_key in present],
+    })
+    table.location_names = get_location_names(table.locations.tolist())
+    return table.sort()
+
+
+def fetch_population_table(location_ids='IT', sex='9', age='TOTAL', start_period='2023-01-01', end_period='2023-12-31'):
+    """
+    Fetches population data as a `PopulationTable`; same arguments as `fetch_population_for_locations_years_sex_age_via_sdmx`.
+
+    Timed stages: "local_lookup" (cache and store), "sdmx_fetch" (download including "sdmx_parse", the decoding time).
+
+    Returns:
+        PopulationTable: The population data sorted by time period, location and age, or None if the request failed.
+    """
+    series_keys = _expand_population_series(location_ids, sex, age, start_period, end_period)
+    with timed_stage("local_lookup"):
+        values, missing = _split_cached_series(series_keys)
+    if missing:
+        # Only the series that are not cached are requested, in as few URLs as the query budgets allow
+        with timed_stage("sdmx_fetch"):
+            fetched = _fetch_series(missing)
+        if fetched is None:
+            return None
+        values.update(fetched)
+    return _population_table_from_series(series_keys, values)
+
+
+async def fetch_population_table_async(location_ids='IT', sex='9', age='TOTAL', start_period='2023-01-01',
+                                       end_period='2023-12-31'):
+    """
+    Async variant of `fetch_population_table`.
+
+    The HTTP response is streamed and decoded chunk by chunk while cache lookups and writes run in a worker
+    thread, so concurrent requests overlap their network waits instead of queuing behind each other on the event loop.
+    """
+    series_keys = _expand_population_series(location_ids, sex, age, start_period, end_period)
+    with timed_stage("local_lookup"):
+        values, missing = await asyncio.to_thread(_split_cached_series, series_keys)
+    if missing:
+        fetched = await _fetch_series_async(missing)
+        if fetched is None:
+            return None
+        values.update(fetched)
+    return _population_table_from_series(series_keys, values)
 
 
 def fetch_population_for_locations_years_sex_age_via_sdmx(location_ids='IT', sex='9', age='TOTAL', start_period='2023-01-01',
@@ -995,25 +1524,95 @@ def fetch_population_for_locations_years_sex_age_via_sdmx(location_ids='IT', sex
          {'location': 'Umbria', 'sex': 'Total', 'age': 'Total', 'time period': '2023', 'population': '856407'},
          {'location': 'Chieti', 'sex': 'Total', 'age': 'Total', 'time period': '2023', 'population': '372640'}]
     """
-    if age.upper() == "TOTAL":
-        combined_age = age.upper()
-    else:
-        combined_age = combine_ages(age)
-    url = f"https://esploradati.istat.it/SDMXWS/rest/data/IT1,22_289_DF_DCIS_POPRES1_1,1.0/A.{location_ids}.JAN.{sex}.{combined_age}.99/ALL/?detail=full&startPeriod={start_period}&endPeriod={end_period}&dimensionAtObservation=TIME_PERIOD"
-    print(url)
-    res = query_api(url)
-    if res is None:
-        return None
-    else:
-        data = extract_and_format_data_from_xml_for_streamlit_app(res)
-        return data
+    table = fetch_population_table(location_ids, sex, age, start_period, end_period)
+    return table.to_rows() if table is not None else None
+
+
+async def fetch_population_for_locations_years_sex_age_via_sdmx_async(location_ids='IT', sex='9', age='TOTAL',
+                                                                 start_period='2023-01-01', end_period='2023-12-31'):
+    """ Async variant of `fetch_population_for_locations_years_sex_age_via_sdmx`. """
+    table = await fetch_population_table_async(location_ids, sex, age, start_period, end_period)
+    return table.to_rows() if table is not None else None
+
+
+# Async implementations of the functions exposed to the LLM in `tools`, keyed by tool name.
+# They return a `PopulationTable`, rendered to JSON only by the API response builder.
+async_tool_functions = {
+    "fetch_population_for_locations_years_sex_age_via_sdmx": fetch_population_table_async,
+}
+
+
+#################################################
+########## Local population store ###############
+#################################################
+
+# ITTER107 location files and the `save_CL_ITTER107_codelist_as_jsonl` extraction type that produces them
+location_type_extraction_types = {
+    '_geographic_areas': 'A',
+    '_regions': 'R',
+    '_provinces': 'P',
+    '_municipalities': 'M',
+}
+
+
+def ingest_population_cube(dataflow_id='22_289', location_types=('_geographic_areas', '_regions', '_provinces', '_municipalities'),
+                           start_year=None, locations_per_request=50):
+    """
+    Downloads the population cube into the local population store, so that queries are answered without calling ISTAT.
+
+    The constraints and ITTER107 location files are generated first if they are missing. Locations are requested
+    in batches, with every sex and age wildcarded, and each response is written to the store while it downloads.
+
+    Args:
+        dataflow_id (str): Identifier of the population data flow, as used by `get_constraints`. Default is '22_289'.
+        location_types (tuple): The ITTER107 location files whose locations are ingested.
+        start_year (int): Only ingest from this year on. Default is None for every published year.
+        locations_per_request (int): Number of locations combined with '+' in each data query.
+
+    Returns:
+        int: The number of observations written to the store.
+    """
+    if not os.path.exists(f"{DATA_ISTAT_API_PATH}/{dataflow_id}__constraints.jsonl"):
+        get_constraints(dataflow_id)
+    location_ids = []
+    for location_type in location_types:
+        if not os.path.exists(f"{DATA_ISTAT_API_PATH}/ITTER107/{location_type}.jsonl"):
+            save_CL_ITTER107_codelist_as_jsonl(location_type_extraction_types[location_type], dataflow_id)
+        location_ids.extend(next(iter(item.values())) for item in read_jsonl_file(f"ITTER107/{location_type}.jsonl", 'list'))
+    location_ids = list(dict.fromkeys(location_ids))
+    period = f"&startPeriod={start_year}-01-01" if start_year else ""
+    written = 0
+    for i in range(0, len(location_ids), locations_per_request):
+        batch = "+".join(location_ids[i:i + locations_per_request])
+        url = (f"https://esploradati.istat.it/SDMXWS/rest/data/IT1,{population_dataflow},1.0/A.{batch}.JAN...99/ALL/"
+               f"?detail=full{period}&dimensionAtObservation=TIME_PERIOD")
+        try:
+            written += store_population_observations(population_dataflow, _stream_population_observations(url))
+        except requests.HTTPError as e:
+            # 404 means no data for this batch (e.g. no new year published yet)
+            if e.response.status_code != 404:
+                print(f"An error occurred while ingesting locations {i}-{i + locations_per_request}: {e}")
+        except (requests.RequestException, CircuitOpenError) as e:
+            print(f"An error occurred while ingesting locations {i}-{i + locations_per_request}: {e}")
+    print(f"{written} observations saved to {POPULATION_STORE_PATH}")
+    return written
+
+
+def refresh_population_store(dataflow_id='22_289', **kwargs):
+    """
+    Ingests only the years published after the most recent year already in the store
+    (everything if the store is empty). Keyword arguments are passed to `ingest_population_cube`.
+    """
+    last_year = get_population_store_last_year(population_dataflow)
+    return ingest_population_cube(dataflow_id, start_year=last_year + 1 if last_year else None, **kwargs)
 
 
 ######################################
 ####### Main process execution #######
 ######################################
+# refresh_metadata_catalog()  # Rebuilds all the metadata files below in one parallel pass
 # fetch_parse_and_save_dataflows()
-locations = assemble_locations()
+# get_catalog().snapshot()  # Precompiled catalog for faster worker startup
 dimensions_seen = set() # Initialize set to track seen dimension_ids
 useful_datastructures = []
 #
@@ -1021,6 +1620,7 @@ useful_datastructures = []
 #     get_datastructures(dataflow_id)
 #     get_constraints(dataflow_id)
 # save_as_jsonl(useful_datastructures, "useful_datastructures.jsonl")
+# save_CL_ITTER107_codelist_as_jsonl("ARPM", "22_289")  # All location levels from one download
 # save_CL_ITTER107_codelist_as_jsonl("A", "22_289")  # For geographic areas
 # save_CL_ITTER107_codelist_as_jsonl("R", "22_289")  # For regions
 # save_CL_ITTER107_codelist_as_jsonl("P", "22_289")  # For provinces
@@ -1029,4 +1629,7 @@ useful_datastructures = []
 # save_codelist_as_xml("CL_ITTER107")
 # save_codelist_as_jsonl("22_289", "CL_SEXISTAT1")
 # save_codelist_as_jsonl("22_289", "CL_ETA1")
+#
+# ingest_population_cube("22_289")  # Bulk download into the local population store
+# refresh_population_store("22_289")  # Add newly published years
 
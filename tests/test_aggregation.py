@@ -0,0 +1,38 @@
+import numpy as np
+
+from modules.table import PopulationTable
+from modules.aggregation import aggregate_age_bands, age_structure_indicators
+
+
+def make_table(populations):
+    """ {(location, sex): population of every single-year age, from Y0 to Y_GE100} -> PopulationTable. """
+    observations = [
+        (location_id, sex, "Y_GE100" if age == 100 else f"Y{age}", "2023", str(population))
+        for (location_id, sex), population in populations.items() for age in range(101)
+    ]
+    return PopulationTable.from_observations(observations)
+
+
+def test_bands_are_summed_for_every_group():
+    result = aggregate_age_bands(make_table({("ITC11", "1"): 1, ("ITC12", "2"): 2}), ["0-14", "15-64", "65+"])
+    assert result["table"].population.tolist() == [15, 50, 36, 30, 100, 72]
+    assert result["totals"].tolist() == [101] * 3 + [202] * 3
+    assert np.allclose(result["shares"][:3], [15 / 101, 50 / 101, 36 / 101])
+
+
+def test_dependency_ratios_and_ageing_index():
+    indicators = age_structure_indicators(make_table({("ITC11", "9"): 1, ("ITC12", "9"): 2}))
+    assert indicators["table"].location_ids().tolist() == ["ITC11", "ITC12"]
+    assert indicators["table"].population.tolist() == [101, 202]
+    assert np.allclose(indicators["youth_dependency"], [30, 30])
+    assert np.allclose(indicators["old_age_dependency"], [72, 72])
+    assert np.allclose(indicators["total_dependency"], [102, 102])
+    assert np.allclose(indicators["ageing_index"], [240, 240])
+    assert np.allclose(indicators["old_share"], [36 / 101, 36 / 101])
+
+
+def test_ratios_without_working_age_population_are_nan():
+    table = PopulationTable.from_observations([("ITC11", "9", "Y70", "2023", "5")])
+    indicators = age_structure_indicators(table)
+    assert np.isnan(indicators["old_age_dependency"][0])
+    assert indicators["old_share"][0] == 1.0
@@ -0,0 +1,23 @@
+from modules.llms import normalize_prompt, _prompt_guard, _completion_cache_key
+
+model_config = {"azure_deployment": "gpt-4o"}
+
+
+def cache_key(prompt):
+    return _completion_cache_key(normalize_prompt(prompt), model_config)
+
+
+def test_range_and_list_of_years_have_different_keys():
+    assert cache_key("Population of Roma in 2020 and 2023") != cache_key("Population of Roma 2020 to 2023")
+    assert cache_key("Popolazione di Roma 2020 e 2023") != cache_key("Popolazione di Roma dal 2020 al 2023")
+
+
+def test_range_and_list_of_years_have_different_guards():
+    and_prompt = normalize_prompt("Population of Roma in 2020 and 2023")
+    to_prompt = normalize_prompt("Population of Roma 2020 to 2023")
+    assert _prompt_guard(and_prompt, None) != _prompt_guard(to_prompt, None)
+
+
+def test_equivalent_phrasings_share_a_key():
+    assert cache_key("What is the population of Roma in 2023?") == cache_key("Popolazione di Roma 2023")
+    assert cache_key("Population of Roma 2020-2023") == cache_key("Population of Roma 2020 to 2023")
@@ -0,0 +1,64 @@
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+import modules.cache as cache
+import modules.planner as planner
+from modules import utils
+
+csv_header = "DATAFLOW,FREQ,REF_AREA,DATA_TYPE,SEX,AGE,MARITAL_STATUS,TIME_PERIOD,OBS_VALUE"
+
+
+def make_csv(url):
+    location_ids = url.split("/A.")[1].split(".")[0].split("+")
+    rows = [f"IT1:22_289_DF_DCIS_POPRES1_1(1.0),A,{location_id},JAN,9,TOTAL,99,2023,100" for location_id in location_ids]
+    return ("\r\n".join([csv_header, *rows]) + "\r\n").encode()
+
+
+@pytest.fixture(autouse=True)
+def local_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache.sdmx_disk_cache, "path", str(tmp_path / "sdmx.sqlite"))
+    cache.sdmx_memory_cache.clear()
+    monkeypatch.setattr(utils, "lookup_population_series", lambda dataflow, series_keys: {})
+    # One location per query, so that each province is its own chunk
+    monkeypatch.setattr(planner, "SDMX_MAX_SERIES_PER_QUERY", 1)
+
+
+def test_chunk_without_data_does_not_discard_the_others(monkeypatch):
+    def query_api_stream(url, headers=None, chunk_size=0):
+        if "ITC12" in url:
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.HTTPError("404 Not Found", response=response)
+        yield make_csv(url)
+
+    monkeypatch.setattr(utils, "query_api_stream", query_api_stream)
+    table = utils.fetch_population_table("ITC11+ITC12", "9", "TOTAL", "2023-01-01", "2023-12-31")
+    assert table.location_ids().tolist() == ["ITC11"]
+    assert cache.get_cached_sdmx((utils.population_dataflow, "ITC12", "9", "TOTAL", "2023")) == ''
+
+
+def test_chunk_without_data_does_not_discard_the_others_async(monkeypatch):
+    async def query_api_stream_async(url, headers=None, chunk_size=0):
+        if "ITC12" in url:
+            raise httpx.HTTPStatusError("404 Not Found", request=httpx.Request("GET", url),
+                                        response=httpx.Response(404))
+        yield make_csv(url)
+
+    monkeypatch.setattr(utils, "query_api_stream_async", query_api_stream_async)
+    table = asyncio.run(utils.fetch_population_table_async("ITC11+ITC12", "9", "TOTAL", "2023-01-01", "2023-12-31"))
+    assert table.location_ids().tolist() == ["ITC11"]
+    assert cache.get_cached_sdmx((utils.population_dataflow, "ITC12", "9", "TOTAL", "2023")) == ''
+
+
+def test_server_error_still_fails_the_request(monkeypatch):
+    def query_api_stream(url, headers=None, chunk_size=0):
+        response = requests.Response()
+        response.status_code = 500
+        raise requests.HTTPError("500 Server Error", response=response)
+        yield
+
+    monkeypatch.setattr(utils, "query_api_stream", query_api_stream)
+    assert utils.fetch_population_table("ITC11", "9", "TOTAL", "2023-01-01", "2023-12-31") is None
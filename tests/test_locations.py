@@ -0,0 +1,31 @@
+import pytest
+
+import modules.locations as locations
+from modules.locations import build_location_index, resolve_location_ids, LOCATION_RESOLVER_MIN_CONFIDENCE
+
+municipality_codes = {"paese": ["026055"], "cesena": ["040007"], "cento": ["038004"], "imola": ["037032"]}
+index = build_location_index([{"Bologna": "ITD55"}, {"Forlì-Cesena": "ITD58"}, {"Italia": "IT"}])
+
+
+@pytest.fixture(autouse=True)
+def municipality_index(monkeypatch):
+    monkeypatch.setattr(locations, "find_municipality_codes", lambda name: municipality_codes.get(name, []))
+    monkeypatch.setattr(locations, "get_municipality_max_words", lambda: 1)
+
+
+def test_common_word_municipality_is_left_to_the_llm():
+    location_ids, confidence = resolve_location_ids("Quanti abitanti ha il paese di Cesena?", index)
+    assert location_ids == "026055+040007"
+    assert confidence < LOCATION_RESOLVER_MIN_CONFIDENCE
+
+
+def test_common_word_municipality_after_a_cue_word_is_resolved():
+    location_ids, confidence = resolve_location_ids("Quanti abitanti ci sono a Cento?", index)
+    assert location_ids == "038004"
+    assert confidence >= LOCATION_RESOLVER_MIN_CONFIDENCE
+
+
+def test_other_municipalities_are_resolved():
+    location_ids, confidence = resolve_location_ids("Popolazione di Imola e Bologna", index)
+    assert location_ids == "037032+ITD55"
+    assert confidence >= LOCATION_RESOLVER_MIN_CONFIDENCE
@@ -0,0 +1,36 @@
+import os
+import json
+
+from modules.table import PopulationTable
+from modules.response import build_population_data
+
+with open(os.path.join(os.path.dirname(__file__), "..", "schema", "schema.json"), encoding="utf-8") as file:
+    row_schema = json.load(file)["properties"]["data"]["items"]
+
+
+def test_merged_rows_keep_sex_and_year_apart_from_the_age_class():
+    table = PopulationTable.from_observations(
+        [("ITC11", "1", "TOTAL", "2023", "5"), ("ITC11", "2", "TOTAL", "2023", "7"), ("ITC11", "9", "TOTAL", "2022", "9")],
+        {"ITC11": "Torino"})
+    rows = build_population_data(table)
+    assert [(row["sexID"], row["sexLabel"], row["timePeriod"]) for row in rows] == [
+        ("1", "Male", "2023"), ("2", "Female", "2023"), ("9", "Total", "2022")]
+    assert rows[0]["categories"] == [{"variableID": "TOTAL", "variableLabel": "Total Population", "value": 5}]
+
+
+def test_age_ranges_use_age_codes():
+    table = PopulationTable.from_observations(
+        [("ITC11", "9", "Y65", "2023", "5"), ("ITC11", "9", "Y_GE100", "2023", "1"), ("ITC12", "9", "Y10", "2023", "2"),
+         ("ITC12", "9", "Y12", "2023", "3")])
+    categories = [row["categories"][0] for row in build_population_data(table.group_sum(("location", "sex", "year")))]
+    assert [(category["variableID"], category["variableLabel"], category["value"]) for category in categories] == [
+        ("Y_GE65", "Age 65-100+", 6), ("Y10-12", "Age 10-12", 5)]
+
+
+def test_rows_follow_the_schema():
+    table = PopulationTable.from_observations([("ITC11", "9", "Y42", "2023", "5")])
+    for row in build_population_data(table):
+        assert set(row_schema["required"]) <= row.keys() <= row_schema["properties"].keys()
+        category_schema = row_schema["properties"]["categories"]["items"]
+        for category in row["categories"]:
+            assert category.keys() == category_schema["properties"].keys()
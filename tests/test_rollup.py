@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from modules.rollup import rollup_population_series
+
+# IT > two areas > two regions each > two provinces each
+children = {
+    "IT": ["ITC", "ITF"],
+    "ITC": ["ITC1", "ITC2"], "ITF": ["ITF1", "ITF2"],
+    "ITC1": ["ITC11", "ITC12"], "ITC2": ["ITC21", "ITC22"], "ITF1": ["ITF11", "ITF12"], "ITF2": ["ITF21", "ITF22"],
+}
+catalog = SimpleNamespace(location_children=children)
+provinces = [province for region in ("ITC1", "ITC2", "ITF1", "ITF2") for province in children[region]]
+
+
+def make_lookup(local_values):
+    looked_up = []
+
+    def lookup(series_keys):
+        looked_up.extend(series_keys)
+        return {series_key: local_values[series_key] for series_key in series_keys if series_key in local_values}
+    return lookup, looked_up
+
+
+def test_total_is_summed_over_every_level():
+    lookup, _ = make_lookup({(province, "9", "TOTAL", "2023"): "10" for province in provinces})
+    values = rollup_population_series([("IT", "9", "TOTAL", "2023"), ("ITC", "9", "TOTAL", "2023")], lookup, catalog)
+    assert values == {("IT", "9", "TOTAL", "2023"): "80", ("ITC", "9", "TOTAL", "2023"): "40"}
+
+
+def test_upper_level_values_are_used_when_known():
+    lookup, looked_up = make_lookup({("ITC", "9", "TOTAL", "2023"): "5", ("ITF", "9", "TOTAL", "2023"): "7"})
+    assert rollup_population_series([("IT", "9", "TOTAL", "2023")], lookup, catalog) == {("IT", "9", "TOTAL", "2023"): "12"}
+    assert not any(series_key[0] in provinces for series_key in looked_up)
+
+
+def test_missing_child_prevents_the_total():
+    local_values = {(province, "9", "TOTAL", "2023"): "10" for province in provinces}
+    local_values[("ITF22", "9", "TOTAL", "2023")] = ""
+    lookup, _ = make_lookup(local_values)
+    values = rollup_population_series([("IT", "9", "TOTAL", "2023"), ("ITC", "9", "TOTAL", "2023")], lookup, catalog)
+    assert values == {("ITC", "9", "TOTAL", "2023"): "40"}
+
+
+def test_cold_cache_does_not_walk_every_descendant():
+    lookup, looked_up = make_lookup({})
+    series_keys = [("IT", sex, f"Y{age}", "2023") for sex in "129" for age in range(100)]
+    assert rollup_population_series(series_keys, lookup, catalog) == {}
+    # One first-child path per series (area, region, province) instead of all 14 descendants
+    assert len(looked_up) == 3 * len(series_keys)